@@ -44,7 +44,7 @@ import urllib
 import urllib2
 import mimetools, mimetypes
 import os, stat, sys
-from cStringIO import StringIO
+import zlib
 
 class Callable:
     def __init__(self, anycallable):
@@ -54,12 +54,163 @@ class Callable:
 #  assigning a sequence.
 doseq = 1
 
+# How much of a file is read at a time when streaming it
+blocksize = 8192
+
+# The zlib window bits for each content coding
+encodings = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+# Responses from servers which will not take a compressed request body
+rejected_encoding = (400, 415, 501)
+
+class MultipartBody:
+    """
+    A multipart/form-data request body which is read as it is sent.
+
+    vars is a sequence of (name, value) strings. files is a sequence of
+    (name, file) where file is either an open file, or a tuple of
+    (filename, chunks, size) with chunks an iterable of strings that add
+    up to size bytes. Nothing is read until the body is, so the length is
+    known up front and a file is never held in memory.
+    """
+    def __init__(self, vars, files, boundary = None):
+        if boundary is None:
+            boundary = mimetools.choose_boundary()
+        self.boundary = boundary
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary
+        self.parts = []
+        self.length = 0
+        for(key, value) in vars:
+            self._add('--%s\r\n' % boundary +
+                      'Content-Disposition: form-data; name="%s"' % key +
+                      '\r\n\r\n' + value + '\r\n')
+        for(key, fd) in files:
+            if isinstance(fd, tuple):
+                filename, source, size = fd
+            else:
+                filename = fd.name.split('/')[-1]
+                size = os.fstat(fd.fileno())[stat.ST_SIZE]
+                fd.seek(0)
+                source = fd
+            contenttype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            self._add('--%s\r\n' % boundary +
+                      'Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (key, filename) +
+                      'Content-Type: %s\r\n\r\n' % contenttype)
+            self.parts.append(source)
+            self.length += size
+            self._add('\r\n')
+        self._add('--' + boundary + '--\r\n\r\n')
+        self.started = False
+        self.seek(0)
+
+    def _add(self, text):
+        self.parts.append(text)
+        self.length += len(text)
+
+    def __len__(self):
+        return self.length
+
+    def _chunks(self):
+        for part in self.parts:
+            if isinstance(part, str):
+                yield part
+            elif hasattr(part, 'read'):
+                while True:
+                    chunk = part.read(blocksize)
+                    if not chunk:
+                        break
+                    yield chunk
+            else:
+                for chunk in part:
+                    yield chunk
+
+    def seek(self, offset):
+        """Go back to the start, so the body can be sent again."""
+        if offset != 0:
+            raise IOError('a multipart body can only be rewound to the start')
+        for part in self.parts:
+            if hasattr(part, 'seek'):
+                part.seek(0)
+            elif not isinstance(part, str) and iter(part) is part and self.started:
+                raise IOError('a multipart body made from an iterator can only be read once')
+        self.started = False
+        self.chunks = self._chunks()
+        self.buffer = ''
+
+    def read(self, size = -1):
+        self.started = True
+        pieces = [self.buffer]
+        have = len(self.buffer)
+        for chunk in self.chunks:
+            pieces.append(chunk)
+            have += len(chunk)
+            if size >= 0 and have >= size:
+                break
+        data = ''.join(pieces)
+        if size < 0:
+            size = len(data)
+        self.buffer = data[size:]
+        return data[:size]
+
+class CompressedBody:
+    """
+    A request body compressed with the gzip or deflate content coding.
+
+    body is a string, or anything with read() such as a MultipartBody.
+    It is compressed a block at a time, and only the compressed data is
+    kept, so the length is known before it is sent. The body it was made
+    from is kept as source, to send it again uncompressed.
+    """
+    def __init__(self, body, encoding = 'gzip', level = 6):
+        self.source = body
+        self.content_encoding = encoding
+        self.content_type = getattr(body, 'content_type', None)
+        compressor = zlib.compressobj(level, zlib.DEFLATED, encodings[encoding])
+        chunks = []
+        if isinstance(body, str):
+            chunks.append(compressor.compress(body))
+        else:
+            while True:
+                block = body.read(blocksize)
+                if not block:
+                    break
+                chunks.append(compressor.compress(block))
+        chunks.append(compressor.flush())
+        self.data = ''.join(chunks)
+        self.position = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def seek(self, offset):
+        self.position = offset
+
+    def read(self, size = -1):
+        if size < 0:
+            size = len(self.data)
+        data = self.data[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+def decode(data, encoding):
+    """Returns a response body without its Content-Encoding."""
+    encoding = (encoding or '').strip().lower()
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            # some servers send raw deflate data, without the zlib header
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    return data
+
 class MultipartPostHandler(urllib2.BaseHandler):
     handler_order = urllib2.HTTPHandler.handler_order - 10 # needs to run first
 
     def http_request(self, request):
         data = request.get_data()
-        if data is not None and type(data) != str:
+        if data is not None and type(data) != str and not isinstance(data, MultipartBody):
             v_files = []
             v_vars = []
             try:
@@ -75,9 +226,9 @@ class MultipartPostHandler(urllib2.BaseHandler):
             if len(v_files) == 0:
                 data = urllib.urlencode(v_vars, doseq)
             else:
-                boundary, data = self.multipart_encode(v_vars, v_files)
+                data = MultipartBody(v_vars, v_files)
 
-                contenttype = 'multipart/form-data; boundary=%s' % boundary
+                contenttype = data.content_type
                 if(request.has_header('Content-Type')
                    and request.get_header('Content-Type').find('multipart/form-data') != 0):
                     print "Replacing %s with %s" % (request.get_header('content-type'), 'multipart/form-data')
@@ -88,27 +239,13 @@ class MultipartPostHandler(urllib2.BaseHandler):
         return request
 
     def multipart_encode(vars, files, boundary = None, buf = None):
-        if boundary is None:
-            boundary = mimetools.choose_boundary()
+        # the whole body as a string, see MultipartBody to stream it instead
+        body = MultipartBody(vars, files, boundary)
         if buf is None:
-            buf = StringIO()
-        for(key, value) in vars:
-            buf.write('--%s\r\n' % boundary)
-            buf.write('Content-Disposition: form-data; name="%s"' % key)
-            buf.write('\r\n\r\n' + value + '\r\n')
-        for(key, fd) in files:
-            file_size = os.fstat(fd.fileno())[stat.ST_SIZE]
-            filename = fd.name.split('/')[-1]
-            contenttype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
-            buf.write('--%s\r\n' % boundary)
-            buf.write('Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (key, filename))
-            buf.write('Content-Type: %s\r\n' % contenttype)
-            # buffer += 'Content-Length: %s\r\n' % file_size
-            fd.seek(0)
-            buf.write('\r\n' + fd.read() + '\r\n')
-        buf.write('--' + boundary + '--\r\n\r\n')
-        buf = buf.getvalue()
-        return boundary, buf
+            return body.boundary, body.read()
+        for chunk in body._chunks():
+            buf.write(chunk)
+        return body.boundary, buf.getvalue()
     multipart_encode = Callable(multipart_encode)
 
     https_request = http_request
@@ -0,0 +1,504 @@
+#!/usr/bin/python
+
+#    benchmark.py
+#    Time the stages of plan2ics against a baseline, and upload2davical
+#    against a local stand-in server.
+#
+#    Copyright (c) 2009, James Mitchell
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import BaseHTTPServer
+import SocketServer
+import datetime
+import json
+import multiprocessing
+import optparse
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from StringIO import StringIO
+from os.path import basename, splitext
+
+import MultipartPostHandler
+import gendayplan
+from plan2ics import dayplan, filter_threshold, read_entries, threshold_batch
+from plan2ics import datetime_rx, exception_rx, decode_header, decode_date
+from plan2ics import decode_fields
+from upload2davical import Connections
+
+# the --weeks threshold for the filter stage, half way through the
+# calendars from gendayplan
+filter_date = datetime.datetime(2010, 7, 1)
+# peak memory below this many kilobytes over the baseline is noise
+memory_slack = 1024
+
+
+class Counter(object):
+    """A file wrapper which counts the bytes through it.
+
+    With a rate in bytes a second, it also waits as long as sending them
+    over a link of that speed would take.
+    """
+
+    def __init__(self, fh, stats, name, rate=None):
+        self.fh = fh
+        self.stats = stats
+        self.name = name
+        self.rate = rate
+
+    def _count(self, data):
+        with self.stats['lock']:
+            self.stats[self.name] += len(data)
+        if self.rate:
+            time.sleep(len(data) / float(self.rate))
+        return data
+
+    def read(self, *args):
+        return self._count(self.fh.read(*args))
+
+    def readline(self, *args):
+        return self._count(self.fh.readline(*args))
+
+    def write(self, data):
+        self._count(data)
+        self.fh.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fh, name)
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Takes uploads the way DaviCal does, and lists the collections."""
+    protocol_version = 'HTTP/1.1'
+    stats = None
+    rate = None
+    listing = ''
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.rfile = Counter(self.rfile, self.stats, 'received', self.rate)
+        self.wfile = Counter(self.wfile, self.stats, 'sent', self.rate)
+
+    def reply(self, code, body=''):
+        encoding = None
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = MultipartPostHandler.CompressedBody(body).read()
+            encoding = 'gzip'
+        self.send_response(code)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.reply(200, self.listing)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        MultipartPostHandler.decode(body, self.headers.get('Content-Encoding'))
+        self.reply(200, 'Updated')
+    do_PUT = do_POST
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve(rate=None, listing=''):
+    """Start a stand-in server, returns (server, stats)."""
+    stats = {'lock': threading.Lock(), 'sent': 0, 'received': 0}
+
+    class Handler(StandInHandler):
+        pass
+    Handler.stats = stats
+    Handler.rate = rate
+    Handler.listing = listing
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, stats
+
+
+def upload(files, encoding=None, rate=None):
+    """Upload files to a stand-in server, the way upload2davical does.
+
+    The collection listing is fetched first, then each calendar is sent
+    with a PUT, the kind of request that is compressed. Responses are
+    always accepted compressed, encoding is for the calendars sent.
+    Returns (bytes sent, bytes received, seconds), with the bytes counted
+    at the server.
+    """
+    calendars = []
+    for file in files:
+        with open(file) as fh:
+            chunks = [chunk.encode('utf-8')
+                      for chunk in dayplan(fh).iter_ics()]
+        calendars.append((splitext(basename(file))[0], chunks))
+    listing = ''.join('<tr><td>/bob/%s/</td><td></td><td></td>'
+                      '<td>2009-10-05 12:00:00.123+13</td></tr>\n' % name
+                      for name, chunks in calendars) * 20
+    server, stats = serve(rate, '<table>%s</table>' % listing)
+    try:
+        http = Connections('http://127.0.0.1:%d' % server.server_port,
+                           encoding=encoding)
+        start = time.time()
+        http.request('GET', '/users.php?user_no=1')
+        for name, chunks in calendars:
+            http.request('PUT', '/caldav.php/bob/%s.ics' % name,
+                         ''.join(chunks), {'Content-Type': 'text/calendar'},
+                         compress=True)
+        seconds = time.time() - start
+        http.close()
+    finally:
+        server.shutdown()
+    return stats['received'], stats['sent'], seconds
+
+
+def _load_stage(text):
+    calendar = dayplan()
+    fh = StringIO(text)
+    yield
+    calendar._load(fh)
+
+
+def _filter_stage(text):
+    events = dayplan(StringIO(text)).events
+    yield
+    # the way dayplan applies --weeks while loading
+    for i in xrange(0, len(events), threshold_batch):
+        filter_threshold(events[i:i + threshold_batch], filter_date)
+
+
+def _pprint_stage(text):
+    calendar = dayplan(StringIO(text))
+    yield
+    calendar.pprint()
+
+
+def _save_plan_stage(text):
+    calendar = dayplan(StringIO(text))
+    out = StringIO()
+    yield
+    calendar.save_plan(out)
+
+
+def _multipart_stage(text):
+    chunks = [chunk.encode('utf-8')
+              for chunk in dayplan(StringIO(text)).iter_ics()]
+    ics = ('bench.ics', chunks, sum(map(len, chunks)))
+    yield
+    body = MultipartPostHandler.MultipartBody(
+        [('cal_name', 'bench'), ('user_no', '1')], [('ics_file', ics)])
+    while body.read(MultipartPostHandler.blocksize):
+        pass
+
+def _dates(text):
+    # the headers, entry line fields and E dates of every entry
+    entries = list(read_entries(StringIO(text)))
+    headers = [header for header, body in entries]
+    fields = [body.split('\n', 1)[0] for header, body in entries]
+    exceptions = [m.group('date') for m in
+                  (exception_rx.match(line) for line in text.splitlines())
+                  if m]
+    return headers, fields, exceptions
+
+
+def _strptime_stage(text):
+    headers, fields, exceptions = _dates(text)
+    yield
+    # the way entries were decoded before decode_header()
+    for header, line in zip(headers, fields):
+        dt = datetime_rx.match(header)
+        if dt.group('time') == '99:99:99':
+            datetime.datetime.strptime(dt.group('date'), '%m/%d/%Y').date()
+        else:
+            datetime.datetime.strptime(
+                '%s %s' % (dt.group('date'), dt.group('time')),
+                '%m/%d/%Y %H:%M:%S')
+        m = re.match(r'\s+(\d+):(\d+):(\d+)', line)
+        if m:
+            datetime.timedelta(hours=int(m.group(1)),
+                               minutes=int(m.group(2)),
+                               seconds=int(m.group(3)))
+    for date in exceptions:
+        datetime.datetime.strptime(date, '%m/%d/%Y')
+
+
+def _decode_stage(text):
+    headers, fields, exceptions = _dates(text)
+    yield
+    for header, line in zip(headers, fields):
+        decode_header(header)
+        decode_fields(line)
+    for date in exceptions:
+        date = decode_date(date)
+        datetime.datetime(date.year, date.month, date.day)
+
+# each stage does its setup, yields, then does the work that is measured
+stages = [
+    ('load', _load_stage),
+    ('filter', _filter_stage),
+    ('pprint', _pprint_stage),
+    ('save_plan', _save_plan_stage),
+    ('multipart', _multipart_stage),
+    ('decode', _decode_stage),
+]
+# what decode is compared with by --decode
+reference_stages = [
+    ('strptime', _strptime_stage),
+]
+
+
+def _maxrss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_stage(args):
+    """Run one stage on the calendar in file, returns (seconds, peak KB).
+
+    The peak is how far the stage raised the peak memory of the process
+    over what its setup had already used.
+    """
+    name, file = args
+    with open(file) as fh:
+        text = fh.read()
+    stage = dict(stages + reference_stages)[name](text)
+    stage.next()
+    rss = _maxrss()
+    start = time.time()
+    for step in stage:
+        pass
+    return time.time() - start, _maxrss() - rss
+
+
+def run_suite(file, repeat=3, names=None):
+    """Time each stage on the calendar in file.
+
+    Every run is in a new process, so one stage cannot warm the caches
+    or grow the memory of the next. Returns {stage: result}, with the
+    fastest of repeat runs and the largest peak. names limits the stages
+    run, and may include the reference_stages.
+    """
+    with open(file) as fh:
+        entries = sum(1 for entry in read_entries(fh))
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    results = {}
+    try:
+        for name in names or [name for name, stage in stages]:
+            runs = [pool.apply(run_stage, ((name, file),))
+                    for i in range(repeat)]
+            seconds = min(seconds for seconds, peak in runs)
+            results[name] = {
+                'seconds': seconds,
+                'entries_per_second': entries / max(seconds, 1e-6),
+                'peak_kb': max(peak for seconds, peak in runs),
+            }
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+# commands for --startup, CALENDAR is replaced with the calendar
+startups = [
+    ('help', ['plan2ics.py', '--help']),
+    ('convert', ['plan2ics.py', 'CALENDAR']),
+    ('zoneinfo', ['plan2ics.py', '--timezone', 'UTC', 'CALENDAR']),
+    ('upload', ['upload2davical.py', '--help']),
+]
+
+
+def run_startup(file, repeat=3):
+    """Time how long each command takes to write its first output.
+
+    Returns results like run_suite(), with the peak memory of the whole
+    command, and the starts a second in place of entries a second.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    with open(os.devnull, 'w') as devnull:
+        for name, command in startups:
+            args = [sys.executable, os.path.join(here, command[0])] + [
+                arg == 'CALENDAR' and file or arg for arg in command[1:]]
+            runs = []
+            for i in range(repeat):
+                start = time.time()
+                process = subprocess.Popen(args, stdout=subprocess.PIPE,
+                                           stderr=devnull)
+                process.stdout.read(1)
+                seconds = time.time() - start
+                process.stdout.read()
+                # wait4 gives the memory used by this command alone
+                pid, status, usage = os.wait4(process.pid, 0)
+                process.returncode = status
+                runs.append((seconds, usage.ru_maxrss))
+            seconds = min(seconds for seconds, peak in runs)
+            results[name] = {
+                'seconds': seconds,
+                'entries_per_second': 1 / max(seconds, 1e-6),
+                'peak_kb': max(peak for seconds, peak in runs),
+            }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns the stages that are slower or use more memory than baseline.
+
+    A stage has regressed when its time or peak memory is more than
+    tolerance (a fraction) over the baseline.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        slower = result['seconds'] > base['seconds'] * (1 + tolerance)
+        larger = result['peak_kb'] > max(base['peak_kb'] * (1 + tolerance),
+                                         base['peak_kb'] + memory_slack)
+        if slower or larger:
+            regressions.append(name)
+    return regressions
+
+
+def wire(files, rate=None):
+    """Print the bytes and time to upload files with each encoding."""
+    print '%-10s %12s %12s %9s' % ('encoding', 'sent', 'received', 'seconds')
+    for encoding in [None] + sorted(MultipartPostHandler.encodings):
+        sent, received, seconds = upload(files, encoding, rate)
+        print '%-10s %12d %12d %9.3f' % (encoding or 'identity', sent,
+                                         received, seconds)
+
+
+def main():
+    usage = "usage: %prog [options] [calendar]"
+    optparser = optparse.OptionParser(usage=usage)
+    optparser.add_option('-n', '--entries', dest='entries',
+                         default=2000,
+                         type="int",
+                         help='without a calendar, generate one with N '
+                         'entries [default: %default]')
+    optparser.add_option('-s', '--seed', dest='seed',
+                         default=0,
+                         type="int",
+                         help='random seed for the generated calendar '
+                         '[default: %default]')
+    optparser.add_option('--repeat', dest='repeat',
+                         default=3,
+                         type="int",
+                         help='runs of each stage [default: %default]')
+    optparser.add_option('-b', '--baseline', dest='baseline',
+                         default=None,
+                         help='compare against the results in FILE, and '
+                         'exit with 1 if any stage regressed.')
+    optparser.add_option('--save', dest='save',
+                         default=None,
+                         help='save the results as a baseline in FILE.')
+    optparser.add_option('-t', '--tolerance', dest='tolerance',
+                         default=0.25,
+                         type="float",
+                         help='fraction over the baseline that is a '
+                         'regression [default: %default]')
+    optparser.add_option('--startup', dest='startup',
+                         default=False,
+                         action="store_true",
+                         help='time how long plan2ics and upload2davical '
+                         'take to start, converting the calendar. Use a '
+                         'small one, such as -n 20.')
+    optparser.add_option('--decode', dest='decode',
+                         default=False,
+                         action="store_true",
+                         help='compare decoding the entry dates and times '
+                         'with decoding them with strptime.')
+    optparser.add_option('--wire', dest='wire',
+                         default=False,
+                         action="store_true",
+                         help='time uploads with each encoding instead.')
+    optparser.add_option('-r', '--rate', dest='rate',
+                         default=None,
+                         type="int",
+                         help='with --wire, simulate a link of N kilobytes '
+                         'a second.')
+    (opts, args) = optparser.parse_args()
+    if len(args) > 1 and not opts.wire:
+        optparser.error('only one calendar can be benchmarked')
+
+    generated = None
+    if not args:
+        fd, generated = tempfile.mkstemp(suffix='.plan')
+        with os.fdopen(fd, 'w') as fh:
+            fh.writelines(gendayplan.generate(opts.entries, opts.seed))
+        args = [generated]
+    try:
+        if opts.wire:
+            wire(args, opts.rate and opts.rate * 1024)
+            return
+        if opts.startup:
+            names = [name for name, command in startups]
+            results = run_startup(args[0], opts.repeat)
+        elif opts.decode:
+            names = ['strptime', 'decode']
+            results = run_suite(args[0], opts.repeat, names)
+        else:
+            names = [name for name, stage in stages]
+            results = run_suite(args[0], opts.repeat)
+    finally:
+        if generated:
+            os.remove(generated)
+
+    baseline = {}
+    if opts.baseline:
+        with open(opts.baseline) as fh:
+            baseline = json.load(fh)['stages']
+    regressions = compare(results, baseline, opts.tolerance)
+    print '%-10s %9s %12s %9s %9s' % ('stage', 'seconds', 'per second',
+                                      'peak KB', 'change')
+    for name in names:
+        result = results[name]
+        change = ''
+        if name in baseline:
+            change = '%+8.1f%%' % (100.0 * result['seconds'] /
+                                   baseline[name]['seconds'] - 100)
+        print '%-10s %9.3f %12.0f %9d %9s%s' % (
+            name, result['seconds'], result['entries_per_second'],
+            result['peak_kb'], change,
+            name in regressions and '  REGRESSED' or '')
+
+    if opts.decode:
+        print 'decoding is %.1f times as fast as strptime' % (
+            results['strptime']['seconds'] / results['decode']['seconds'])
+
+    if opts.save:
+        with open(opts.save, 'w') as fh:
+            calendar = {'calendar': args[0]}
+            if generated:
+                calendar = {'entries': opts.entries, 'seed': opts.seed}
+            json.dump(dict(calendar, python=sys.version.split()[0],
+                           stages=results), fh, indent=2, sort_keys=True)
+            fh.write('\n')
+    if regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#    gendayplan.py
+#    Generate dayplan files for testing and benchmarking plan2ics.
+#
+#    Copyright (c) 2009, James Mitchell
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import optparse
+import random
+import sys
+
+epoch = datetime.date(1970, 1, 1)
+
+# the fraction of entries with each feature, see generate()
+default_mix = {
+    'allday': 0.3,      # no trigger time
+    'repeat': 0.4,      # an R line
+    'until': 0.5,       # the R line stops repeating at some date
+    'exception': 0.2,   # up to four E lines
+    'long': 0.1,        # a long description over many M lines
+    'unicode': 0.1,     # non-ASCII text in the note and description
+    'where': 0.1,       # a location, after @ in the note or on a Where line
+}
+
+# R line patterns, picked with equal chances
+repeats = ('daily', 'weekly', 'nth-weekday', 'monthday', 'yearly')
+
+words = ('meeting', 'lunch', 'review', 'call', 'dentist', 'project', 'team',
+         'budget', 'planning', 'training', 'dinner', 'school', 'report',
+         'deadline', 'football', 'birthday', 'the', 'with', 'about', 'for')
+unicode_words = (u'Caf\xe9', u'Z\xfcrich', u'\xc6r\xf8sk\xf8bing',
+                 u'cr\xe8me br\xfbl\xe9e', u'na\xefve', u'東京',
+                 u'Москва', u'non\xa0breaking')
+places = ('the office', 'room 4', 'the pool', 'town hall', 'home')
+
+
+def _text(rnd, count, use_unicode):
+    text = [rnd.choice(words) for i in range(count)]
+    if use_unicode:
+        text[rnd.randrange(count)] = rnd.choice(unicode_words)
+    return u' '.join(text).encode('utf-8')
+
+
+def _seconds(day):
+    return (day - epoch).days * 86400
+
+
+def _repeat(rnd, day, until):
+    """Returns the five fields of an R line for a random pattern."""
+    pattern = rnd.choice(repeats)
+    delete = until and _seconds(day + datetime.timedelta(
+        days=rnd.randrange(30, 3 * 365))) or 0
+    if pattern == 'daily':
+        return rnd.choice((1, 1, 2, 7, 14)) * 86400, delete, 0, 0, 0
+    elif pattern == 'weekly':
+        days = rnd.randrange(1, 128)
+        return 0, delete, days, 0, 0
+    elif pattern == 'nth-weekday':
+        days = 1 << rnd.randrange(7)
+        weeks = rnd.randrange(1, 64) << 8
+        return 0, delete, days | weeks, 0, 0
+    elif pattern == 'monthday':
+        monthdays = 0
+        for i in range(rnd.randrange(1, 4)):
+            monthdays |= 1 << rnd.randrange(32)
+        return 0, delete, 0, monthdays, 0
+    else:
+        return 0, delete, 0, 0, 1
+
+
+def generate(entries, seed=0, mix=None, start=datetime.date(2008, 1, 1),
+             days=5 * 365):
+    """Yield the lines of a dayplan file with entries entries.
+
+    The entries start on random days in the days after start. mix gives
+    the fraction of entries with each feature, any left out are taken from
+    default_mix. The same arguments always give the same file.
+    """
+    rnd = random.Random(seed)
+    fractions = dict(default_mix)
+    fractions.update(mix or {})
+    has = lambda feature: rnd.random() < fractions[feature]
+    yield '#\tgenerated by gendayplan, %d entries, seed %s\n' % (entries, seed)
+    for i in xrange(entries):
+        day = start + datetime.timedelta(days=rnd.randrange(days))
+        if has('allday'):
+            trigger = '99:99:99'
+        else:
+            trigger = '%d:%d:0' % (rnd.randrange(6, 22),
+                                   rnd.choice((0, 15, 30, 45)))
+        length = '%d:%d:0' % (rnd.randrange(3), rnd.choice((0, 15, 30)))
+        yield '%d/%d/%d  %s  %s  0:0:0  0:0:0  ---------- 0 0\n' % (
+            day.month, day.day, day.year, trigger, length)
+        if has('repeat'):
+            yield 'R\t%d %d %d %d %d\n' % _repeat(rnd, day, has('until'))
+            if has('exception'):
+                for j in range(rnd.randrange(1, 5)):
+                    exception = day + datetime.timedelta(
+                        days=rnd.randrange(1, 365))
+                    yield 'E\t%d/%d/%d\n' % (exception.month, exception.day,
+                                             exception.year)
+        use_unicode = has('unicode')
+        note = _text(rnd, rnd.randrange(1, 5), use_unicode)
+        where = has('where')
+        if where and rnd.random() < 0.5:
+            note += ' @ ' + rnd.choice(places)
+            where = False
+        yield 'N\t%s %d\n' % (note, i)
+        lines = rnd.randrange(10, 40) if has('long') else rnd.randrange(3)
+        for j in range(lines):
+            yield 'M\t%s\n' % _text(rnd, rnd.randrange(3, 12), use_unicode)
+        if where:
+            yield 'M\tWhere: %s\n' % rnd.choice(places)
+
+
+def main():
+    usage = "usage: %prog [options]"
+    optparser = optparse.OptionParser(usage=usage)
+    optparser.add_option('-n', '--entries', dest='entries',
+                         default=1000,
+                         type="int",
+                         help='number of entries [default: %default]')
+    optparser.add_option('-s', '--seed', dest='seed',
+                         default=0,
+                         type="int",
+                         help='random seed [default: %default]')
+    optparser.add_option('-m', '--mix', dest='mix',
+                         default=[],
+                         action="append",
+                         metavar='FEATURE=FRACTION',
+                         help='the fraction of entries with a feature, one of '
+                         '%s. Can be given more than once.'
+                         % ', '.join(sorted(default_mix)))
+    optparser.add_option('-o', '--output', dest='output',
+                         default=None,
+                         help='write to FILE instead of stdout.')
+
+    (opts, args) = optparser.parse_args()
+    mix = {}
+    for option in opts.mix:
+        try:
+            feature, fraction = option.split('=')
+            if feature not in default_mix:
+                raise ValueError
+            mix[feature] = float(fraction)
+        except ValueError:
+            optparser.error('--mix must be FEATURE=FRACTION, with FEATURE '
+                            'one of %s' % ', '.join(sorted(default_mix)))
+    out = sys.stdout
+    if opts.output:
+        out = open(opts.output, 'w')
+    try:
+        out.writelines(generate(opts.entries, opts.seed, mix))
+    finally:
+        if opts.output:
+            out.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#    lazymodule.py
+#    Modules which are imported on first use.
+#
+#    Copyright (c) 2009, James Mitchell
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import importlib
+
+
+class LazyModule(object):
+    """Stands in for a module, which is only imported when it is first used.
+
+        vobject = LazyModule('vobject')
+
+    The module is imported the first time an attribute is looked up, and
+    its attributes are then copied onto the stand-in, so later lookups cost
+    the same as on the module. An optional module which is not installed
+    makes the stand-in false, where the eager code would have set it to
+    None, and any attribute lookup raises the ImportError.
+    """
+
+    def __init__(self, name, optional=False):
+        self.__name = name
+        self.__optional = optional
+        self.__loaded = False
+
+    def __load(self):
+        if not self.__loaded:
+            module = importlib.import_module(self.__name)
+            self.__dict__.update(module.__dict__)
+            self.__loaded = True
+
+    def __getattr__(self, attr):
+        # only called for attributes not copied from the module yet
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        self.__load()
+        try:
+            return self.__dict__[attr]
+        except KeyError:
+            raise AttributeError("'module' object has no attribute '%s'"
+                                 % attr)
+
+    def __nonzero__(self):
+        try:
+            self.__load()
+        except ImportError:
+            if self.__optional:
+                return False
+            raise
+        return True
+
+    def __repr__(self):
+        state = self.__loaded and 'imported' or 'not imported yet'
+        return '<lazy module %r, %s>' % (self.__name, state)
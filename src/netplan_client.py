@@ -7,11 +7,19 @@ open_rx = re.compile(r'^o(?P<status>[tf])(?P<mode>[rw])(?P<file>\d+)$')
 rowcount_rx = re.compile(r'^n(?P<file>\d+)\s+(?P<rows>\d+)$')
 read_rx = re.compile(r'^[rR](?P<status>[tf])(?P<file>\d+)\s+(?P<row_number>\d+)\s+(?P<row_data>.+)$')
 write_rx = re.compile(r'w(?P<status>[tf])(?P<row_number>\d+)')
+escape_rx = re.compile(r'\\(.)')
 
 CR = '\r'
 LF = '\n'
 CRLF = CR + LF
 
+# how many row requests are sent ahead of the replies
+pipeline_depth = 256
+
+
+class NetplanError(Exception):
+    pass
+
 
 class NetplanClient(object):
 
@@ -20,7 +28,8 @@ class NetplanClient(object):
     plan_calendar = None
     filenumber = None
 
-    def __init__(self, host=None, port=2983):
+    def __init__(self, host=None, port=2983, depth=pipeline_depth):
+        self.depth = depth
         if host:
             self.connect(host, port)
 
@@ -33,29 +42,96 @@ class NetplanClient(object):
 
     def disconnect(self):
         self.send('q')
-        self.sock.shutdown()
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.file.close()
         self.sock.close()
 
     def send(self, msg):
         self.sock.sendall('%s%s' % (msg, CRLF))
         return
 
+    def send_many(self, msgs):
+        # one write for a whole batch of requests
+        self.sock.sendall(''.join('%s%s' % (msg, CRLF) for msg in msgs))
+
     def receive(self):
-        return self.file.readline()
+        line = self.file.readline()
+        if not line:
+            raise NetplanError('connection closed by the netplan server')
+        return line.rstrip(CRLF)
+
+    def expect(self, rx):
+        # skip replies that are not the one waited for
+        while True:
+            m = rx.match(self.receive())
+            if m:
+                return m
 
     @property
     def client_id(self):
         return '%s<uid=%s,gid=%s,pid=%s>' % (self.__module__, os.getuid(),
                                              os.getgid(), os.getpid())
 
+    def open_calendar(self, calendar, mode='r'):
+        '''Open a calendar on the server, and return its file number.'''
+        self.send('o%s%s' % (mode, calendar))
+        m = self.expect(open_rx)
+        if m.group('status') != 't':
+            raise NetplanError('cannot open calendar %s' % calendar)
+        self.filenumber = m.group('file')
+        return self.filenumber
+
+    def close_calendar(self, filenumber):
+        self.send('c%s' % filenumber)
+
+    def row_count(self, filenumber):
+        self.send('n%s' % filenumber)
+        return int(self.expect(rowcount_rx).group('rows'))
+
+    def read_rows(self, filenumber, rows):
+        '''Yield the data of rows 0..rows-1, in order.
+
+        Up to depth requests are kept in flight, so the replies stream
+        back without a round trip for each row.
+        '''
+        requested = 0
+        for row in xrange(rows):
+            if requested < rows and requested - row < self.depth // 2 + 1:
+                # top the pipeline up in batches of half its depth
+                batch = min(rows, row + self.depth) - requested
+                self.send_many('r%s %d' % (filenumber, number)
+                               for number in xrange(requested,
+                                                    requested + batch))
+                requested += batch
+            m = self.expect(read_rx)
+            if m.group('status') != 't' or m.group('file') != filenumber or \
+                    int(m.group('row_number')) != row:
+                raise NetplanError('cannot read row %d of file %s'
+                                   % (row, filenumber))
+            yield m.group('row_data')
+
     def get_calendar(self, calendar):
-        self.send('o' + calendar)
-        response = self.receive()
-        m = open_rx.match(response)
-        if m:
-            status = m.group('status')
-            self.filenumber = m.group('file')
-        if self.filenumber:
-            self.send('r%s 0' % self.filenumber)
-            for response in self.receive():
-                print response
+        '''Yield the lines of a calendar, the same as reading its file.
+
+        Each row is one entry, with its line breaks written as \\n. The
+        lines can be passed straight to plan2ics.dayplan().
+        '''
+        filenumber = self.open_calendar(calendar)
+        try:
+            for data in self.read_rows(filenumber,
+                                       self.row_count(filenumber)):
+                for line in unescape(data).splitlines():
+                    yield line + LF
+        finally:
+            self.close_calendar(filenumber)
+
+
+def unescape(data):
+    '''Returns row data with \\n turned back into line breaks.'''
+    return escape_rx.sub(lambda m: LF if m.group(1) == 'n' else m.group(1),
+                         data)
+
+
+def escape(text):
+    '''Returns text as row data, the reverse of unescape().'''
+    return text.replace('\\', '\\\\').replace(LF, '\\n')
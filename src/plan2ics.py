@@ -25,21 +25,39 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
 import re
+import collections
+import functools
+import itertools
+import heapq
+import bisect
+import sys
+import time
+import shelve
+import shutil
+import tempfile
+import threading
 import optparse
-import vobject
+import multiprocessing
 import datetime
 import uuid
-from dateutil.rrule import rruleset, rrulestr
 from string import maketrans
-
-import PyICU
+from StringIO import StringIO
 
 import hashlib
 
+import planstats
+from lazymodule import LazyModule
+
+# imported when first used, so that --help and small runs start quickly
+vobject = LazyModule('vobject')
+rrule = LazyModule('dateutil.rrule')
+PyICU = LazyModule('PyICU')
+tz = LazyModule('dateutil.tz')
+pyinotify = LazyModule('pyinotify', optional=True)
+
 datetime_rx = re.compile(r'(?P<date>\d+/\d+/\d+)\s+(?P<time>\d+:\d+:\d+)')
-duration_rx = re.compile(
-    r'\s+(?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>\d+)')
 exception_rx = re.compile(r'E\s+(?P<date>\d+/\d+/\d+)')
 repeat_rx = re.compile(
     r'R\s+(?P<trigger_secs>\d+)\s+(?P<delete_secs>\d+)\s+(?P<weekdaymap>\d+)\s+(?P<monthdaymap>\d+)\s+(?P<yearly>\d)')
@@ -70,21 +88,609 @@ weeknumber = (
 )
 one_day = datetime.timedelta(days=1)
 translate_map = maketrans('\xa0', ' ')
+ics_trailer = 'END:VCALENDAR\r\n'
+cache_version = 5
+script_version = 1
+threshold_batch = 256
+freebusy_weeks = 4
+watch_interval = 1.0
+# dates, times and headers remembered by decode_header() and friends
+decode_memo_size = 4096
+# years after this one covered by the VTIMEZONE of repeats without an end
+vtimezone_years = 10
+
+
+def read_entries(fh):
+    """Yield (header, body) pairs from a dayplan file, one entry at a time.
+
+    An entry starts on a line beginning with a digit (see plan(4)). The
+    header is the trigger date and time, the body is the rest of the entry
+    line plus every following line up to the next entry. Lines before the
+    first entry (the dayplan header types) are skipped.
+    """
+    header = None
+    body = []
+    for line in fh:
+        if line[:1].isdigit():
+            dt = datetime_rx.match(line)
+            if dt:
+                if header is not None:
+                    yield (header, ''.join(body))
+                header = dt.group(0)
+                body = [line[dt.end():]]
+                continue
+        if header is not None:
+            body.append(line)
+    if header is not None:
+        yield (header, ''.join(body))
+
+
+def memoize(maxsize, key=None):
+    """Decorator that remembers the results of the last maxsize calls.
+
+    The least recently used result is dropped when there are more. The
+    results are looked up by the arguments, or by key(*arguments). The
+    results are shared by threads, so they are only touched under a lock;
+    the function itself is called outside it.
+    """
+    def decorator(function):
+        results = collections.OrderedDict()
+        lock = threading.Lock()
+
+        @functools.wraps(function)
+        def wrapper(*args):
+            name = args if key is None else key(*args)
+            with lock:
+                try:
+                    result = results.pop(name)
+                    results[name] = result
+                    return result
+                except KeyError:
+                    pass
+            result = function(*args)
+            with lock:
+                results.pop(name, None)
+                if len(results) >= maxsize:
+                    results.popitem(last=False)
+                results[name] = result
+            return result
+        return wrapper
+    return decorator
+
+
+# the decoded dates and times of dayplan files, see decode_header()
+_dates = {}
+_times = {}
+_headers = {}
+_fields = {}
+
+
+def _remember(memo, key, value):
+    # a plain dict is quicker than memoize(), and is emptied when it fills
+    if len(memo) >= decode_memo_size:
+        memo.clear()
+    memo[key] = value
+    return value
+
+
+def decode_date(text):
+    """Returns the date for the m/d/y date of a dayplan file.
+
+    Two digit years 70..99 are 1970..1999 and 00..38 are 2000..2038, as
+    plan(4) allows. Raises ValueError for anything that is not a date.
+    """
+    value = _dates.get(text)
+    if value is not None:
+        return value
+    month, day, year = text.split('/')
+    year = int(year)
+    if year < 100:
+        if year >= 70:
+            year += 1900
+        elif year <= 38:
+            year += 2000
+        else:
+            raise ValueError('year out of range: %s' % text)
+    return _remember(_dates, text, datetime.date(year, int(month), int(day)))
+
+
+def _decode_hms(text):
+    value = _times.get(text)
+    if value is not None:
+        return value
+    hours, minutes, seconds = text.split(':')
+    return _remember(_times, text, (int(hours), int(minutes), int(seconds)))
+
+
+def decode_header(header):
+    """Returns the start of an entry from its m/d/y h:m:s header.
+
+    Entries without a trigger time (99:99:99) start on a date, the others
+    at a datetime. Dayplan files use the same few dates and times over and
+    over, so the headers, dates and times decoded are remembered.
+    """
+    value = _headers.get(header)
+    if value is not None:
+        return value
+    date, time = header.split()
+    date = decode_date(date)
+    if time != '99:99:99':
+        hours, minutes, seconds = _decode_hms(time)
+        date = datetime.datetime(date.year, date.month, date.day,
+                                 hours, minutes, seconds)
+    return _remember(_headers, header, date)
+
+
+def decode_fields(line):
+    """Returns (length, early warning, late warning) from an entry line.
+
+    line is the rest of the line after the trigger date and time. The
+    fields are timedeltas, or None when they are missing or not h:m:s.
+    """
+    value = _fields.get(line)
+    if value is not None:
+        return value
+    fields = []
+    for field in line.split(None, 3)[:3]:
+        try:
+            hours, minutes, seconds = _decode_hms(field)
+        except ValueError:
+            fields.append(None)
+        else:
+            fields.append(datetime.timedelta(hours=hours, minutes=minutes,
+                                             seconds=seconds))
+    fields.extend([None] * (3 - len(fields)))
+    return _remember(_fields, line, tuple(fields))
+
+
+@memoize(64)
+def zoneinfo(name):
+    """Returns the timezone called name, read from the zoneinfo files.
+
+    This does without ICU, which takes longer to load. Raises ValueError
+    for a name that is not in the zoneinfo database.
+    """
+    timezone = tz.gettz(name)
+    if timezone is None or not name:
+        raise ValueError('unknown timezone: %s' % name)
+    # vobject takes the TZID from a tzid attribute
+    timezone.tzid = name
+    return timezone
+
+
+def event_years(events):
+    """Returns (first, last), the years events happen in, or None.
+
+    Repeating events count up to the end of their recurrences, or
+    vtimezone_years after this year when they do not end.
+    """
+    horizon = datetime.date.today().year + vtimezone_years
+    first = last = None
+    for event in events:
+        start = event.dtstart.year
+        end = event.dtend.year
+        for value, params in event.rrules:
+            until = params.get('until')
+            end = max(end, until and until.year or horizon)
+        if first is None:
+            first, last = start, end
+        else:
+            first = min(first, start)
+            last = max(last, end)
+    if first is None:
+        return None
+    return first, last
+
+
+@memoize(64, key=lambda timezone, tzid, span=None: (timezone, tzid, span))
+def vtimezone(timezone, tzid, span=None):
+    """Returns a VTIMEZONE component for timezone.
+
+    Only the transitions in the years span, (first, last), are written, or
+    those of the vobject default years when span is None. Working out the
+    transitions takes a while, so the components are kept for each
+    timezone, tzid and span. They are shared, and must not be changed.
+    """
+    component = vobject.icalendar.TimezoneComponent()
+    if span:
+        # start with the year before, so that an onset comes before events
+        # early in the first year
+        first, last = span
+        component.settzinfo(timezone, first - 1, last)
+    else:
+        component.settzinfo(timezone)
+    return component
+
+
+@memoize(64, key=lambda timezone, tzid, span=None: (timezone, tzid, span))
+def ics_header(timezone, tzid, span=None):
+    """The start of a calendar, up to and including the VTIMEZONE."""
+    header = vobject.iCalendar()
+    header.add(vtimezone(timezone, tzid, span))
+    header = header.serialize()
+    return unicode(header[:-len(ics_trailer)], 'utf-8')
+
+
+@memoize(1024)
+def translate_repeat(trigger_secs, delete_secs, weekdaymap, monthdaymap,
+                     yearly, allday=False):
+    """Translate the fields of an R line into (RRULE value, rrule parameters).
+
+    The parameters are the keyword arguments for dateutil.rrule.rrule, apart
+    from dtstart. Calendars repeat the same few R lines many times, so the
+    results are memoized. They are shared, and must not be changed.
+    """
+    params = {}
+    values = []
+    if yearly:
+        params['freq'] = rrule.YEARLY
+    elif monthdaymap:
+        params['freq'] = rrule.MONTHLY
+        daylist = [i for i in range(1, 31) if monthdaymap & (1 << i)]
+        # bit 0 is set, so it is the last day of the month
+        if monthdaymap & 1:
+            daylist.append(-1)
+        if daylist:
+            params['bymonthday'] = tuple(daylist)
+    elif weekdaymap:
+        days = [i for i in range(7) if weekdaymap & (1 << i)]
+        weeks = [weeknumber[i - 8] for i in range(8, 14)
+                 if weekdaymap & (1 << i)]
+        if weeks:
+            params['freq'] = rrule.MONTHLY
+            params['bysetpos'] = tuple(int(week) for week in weeks)
+            values.append('BYSETPOS=%s' % ','.join(weeks))
+        else:
+            params['freq'] = rrule.WEEKLY
+        if days:
+            # dateutil counts weekdays from Monday, plan from Sunday
+            params['byweekday'] = tuple((i + 6) % 7 for i in days)
+            values.append('BYDAY=%s' % ','.join(weekday[i] for i in days))
+    else:
+        params['freq'] = rrule.DAILY
+    if trigger_secs:
+        params['interval'] = trigger_secs / 86400
+        if params['interval'] != 1:
+            values.append('INTERVAL=%s' % params['interval'])
+    if delete_secs:
+        dt_until = epoch + datetime.timedelta(seconds=delete_secs)
+        params['until'] = datetime.datetime.combine(dt_until, datetime.time(0))
+        if allday:
+            values.append('UNTIL=%s' % dt_until.strftime('%Y%m%d'))
+        else:
+            values.append('UNTIL=%s' % dt_until.strftime('%Y%m%dT000000'))
+    if 'bymonthday' in params:
+        values.append('BYMONTHDAY=%s' % ','.join(
+            str(day) for day in params['bymonthday']))
+    values.insert(0, 'FREQ=%s' % ('YEARLY', 'MONTHLY', 'WEEKLY', 'DAILY')[
+        params['freq']])
+    return ';'.join(values), params
+
+
+def _naive(value):
+    """Returns a date or datetime as a datetime without a timezone."""
+    if isinstance(value, datetime.datetime):
+        return value.replace(tzinfo=None)
+    return datetime.datetime(value.year, value.month, value.day)
+
+
+def _threshold_bound(event):
+    """Returns (recurring, bound) for an event.
+
+    bound is the latest time the event can happen at, or datetime.max if it
+    repeats forever.
+    """
+    if not (event.rrules or event.exdates):
+        # single events count until the start of the day they end on
+        dtend = event.dtend
+        return False, datetime.datetime(dtend.year, dtend.month, dtend.day)
+    if not event.rrules:
+        # only exceptions, so the event never happens
+        return True, datetime.datetime.min
+    bound = datetime.datetime.min
+    for value, params in event.rrules:
+        until = params.get('until')
+        if until is None:
+            return True, datetime.datetime.max
+        bound = max(bound, until)
+    return True, bound
+
+
+def _occurs_after(event, threshold):
+    """Returns True if a repeating event happens after threshold."""
+    if len(event.rrules) == 1:
+        value, params = event.rrules[0]
+        interval = params.get('interval', 1)
+        if params['freq'] == rrule.DAILY and interval:
+            # daily events happen every interval days from dtstart, so the
+            # first one after threshold can be worked out directly
+            dtstart = _naive(event.dtstart)
+            step = datetime.timedelta(days=interval)
+            if dtstart > threshold:
+                occurrence = dtstart
+            else:
+                steps = int((threshold - dtstart).total_seconds() //
+                            step.total_seconds()) + 1
+                occurrence = dtstart + steps * step
+            until = params.get('until', datetime.datetime.max)
+            while occurrence <= until:
+                if occurrence not in event.exdates:
+                    return True
+                occurrence += step
+            return False
+    return event.rruleset.after(threshold) is not None
+
+
+def _skip_periods(params, dtstart, earliest):
+    """Returns dtstart moved forward by whole periods of a rule.
+
+    Daily and weekly rules repeat the same pattern every period, so the
+    occurrences from the returned time on are the same as from dtstart.
+    It stays at or before earliest. Other rules are left alone.
+    """
+    interval = params.get('interval', 1)
+    if params['freq'] == rrule.DAILY:
+        period = datetime.timedelta(days=interval)
+    elif params['freq'] == rrule.WEEKLY:
+        period = datetime.timedelta(weeks=interval)
+    else:
+        return dtstart
+    if not interval or dtstart >= earliest:
+        return dtstart
+    steps = int((earliest - dtstart).total_seconds() // period.total_seconds())
+    return dtstart + steps * period
+
+
+def expand(events, start, end):
+    """Yield (dtstart, event) for each occurrence that overlaps start..end.
+
+    The occurrences of all events are merged in order of their start time.
+    Each event only has its next occurrence pending, so memory use does not
+    grow with the length of the window.
+    """
+    def occurrences(index, event):
+        for occurrence in event.occurrences(start, end):
+            yield occurrence, index, event
+    for occurrence, index, event in heapq.merge(
+            *[occurrences(index, event)
+              for index, event in enumerate(events)]):
+        yield occurrence, event
+
+
+def merge_periods(periods):
+    """Yield the (start, end) periods merged where they overlap or touch.
+
+    The periods must be in order of their start time, which is the order
+    expand() gives them in, so a single pass over them is enough.
+    """
+    current = None
+    for start, end in periods:
+        if current is not None and start <= current[1]:
+            if end > current[1]:
+                current[1] = end
+            continue
+        if current is not None:
+            yield tuple(current)
+        current = [start, end]
+    if current is not None:
+        yield tuple(current)
+
+
+def parse_window(text):
+    """Parse a FROM..TO window of dates written as YYYY-MM-DD.
+
+    Returns (start, end) datetimes. TO is included, so end is the midnight
+    after it.
+    """
+    try:
+        start, end = text.split('..')
+        start = datetime.datetime.strptime(start, '%Y-%m-%d')
+        end = datetime.datetime.strptime(end, '%Y-%m-%d') + one_day
+    except ValueError:
+        raise ValueError('window must be written as YYYY-MM-DD..YYYY-MM-DD')
+    return start, end
+
+
+def freebusy_window():
+    """Returns the default --freebusy window, the next freebusy_weeks."""
+    start = datetime.datetime.combine(datetime.date.today(), datetime.time(0))
+    return start, start + datetime.timedelta(weeks=freebusy_weeks)
+
+
+def filter_threshold(events, threshold):
+    """Returns a list with True for each event that happens after threshold.
+
+    Single events are kept if they end on or after the day of threshold.
+    Repeating events are decided from the UNTIL of their recurrences where
+    that is enough. Only the ones that end after threshold need their
+    recurrences looked at.
+    """
+    current = []
+    unsure = []
+    for i, event in enumerate(events):
+        recur, bound = _threshold_bound(event)
+        if recur:
+            current.append(bound > threshold)
+            if current[-1] and bound != datetime.datetime.max:
+                unsure.append(i)
+        else:
+            current.append(bound >= threshold)
+    for i in unsure:
+        current[i] = _occurs_after(events[i], threshold)
+    return current
+
+
+def split_ranges(file, parts):
+    """Split file into at most parts (start, end) byte ranges.
+
+    Every range but the first starts on an entry line, so each one can be
+    read by read_entries() on its own.
+    """
+    size = os.path.getsize(file)
+    offsets = [0]
+    with open(file, mode='r') as fh:
+        for i in range(1, parts):
+            target = size * i // parts
+            if target <= offsets[-1]:
+                continue
+            # start from the end of the previous line, in case an entry
+            # starts right at target
+            fh.seek(target - 1)
+            fh.readline()
+            while True:
+                offset = fh.tell()
+                line = fh.readline()
+                if not line:
+                    break
+                if line[:1].isdigit() and datetime_rx.match(line):
+                    break
+            if offsets[-1] < offset < size:
+                offsets.append(offset)
+    offsets.append(size)
+    return zip(offsets[:-1], offsets[1:])
+
+
+def read_range(fh, start, end):
+    """Yield the lines of fh from byte offset start up to end."""
+    fh.seek(start)
+    while fh.tell() < end:
+        line = fh.readline()
+        if not line:
+            break
+        yield line
+
+
+def _read_range(args):
+    # parse one range of a file, in a worker process
+    file, start, end, verbose = args
+    with open(file, mode='r') as fh:
+        return [Event(plan_event, verbose)
+                for plan_event in read_entries(read_range(fh, start, end))]
+
+
+def cache_key(entry, tzid=None):
+    """Returns the cache key of a (header, body) entry.
+
+    The key covers the whole entry, so any change to it is a cache miss.
+    """
+    return hashlib.md5('%s\0%s\0%s%s' % (cache_version, tzid, entry[0],
+                                           entry[1])).hexdigest()
+
+
+def open_cache(cache_dir, file):
+    """Open the on-disk cache of converted entries for a dayplan file."""
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    name = hashlib.md5(os.path.abspath(file)).hexdigest()
+    return shelve.open(os.path.join(cache_dir, name), protocol=2)
+
+
+def _fold(line, length=75):
+    """Fold a content line at length octets, as vobject does (RFC 5545 3.1).
+
+    Multi-byte UTF-8 sequences are not split across lines.
+    """
+    if len(line) < length:
+        return line + '\r\n'
+    try:
+        chars = line.decode('utf-8')
+    except UnicodeDecodeError:
+        chars = line
+    out = []
+    counter = 0
+    for char in chars:
+        if isinstance(char, unicode):
+            char = char.encode('utf-8')
+        if counter + len(char) > length:
+            out.append('\r\n ')
+            counter = 1
+        out.append(char)
+        counter += len(char)
+    out.append('\r\n')
+    return ''.join(out)
+
+
+def _escape_text(text):
+    """Escape a TEXT property value (RFC 5545 3.3.11)."""
+    text = text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+    return (text.replace('\r\n', '\\n').replace('\n', '\\n')
+            .replace('\r', '\\n'))
+
+
+def _param(value):
+    if ',' in value or ';' in value or ':' in value:
+        return '"%s"' % value
+    return value
+
+
+def _format_datetime(name, value, tzid=None):
+    """Returns the content line for a DATE or DATE-TIME property."""
+    if not isinstance(value, datetime.datetime):
+        return '%s;VALUE=DATE:%04d%02d%02d' % (
+            name, value.year, value.month, value.day)
+    text = '%04d%02d%02dT%02d%02d%02d' % (
+        value.year, value.month, value.day,
+        value.hour, value.minute, value.second)
+    if value.tzinfo is None:
+        return '%s:%s' % (name, text)
+    elif tzid:
+        return '%s;TZID=%s:%s' % (name, _param(tzid), text)
+    else:
+        return '%s:%sZ' % (name, text)
 
 
 class Event(object):
-    _uid = None
-    vevent = None   # ICS version of event
-    pevent = None   # array containing netplan version of event
-    extra = None
-    verbose = False
+    """A netplan entry and the VEVENT fields converted from it.
 
-    def __init__(self, vevent, event, verbose=False):
-        self.vevent = vevent
+    The fields are kept as plain values. The vobject component is only
+    built when vevent is asked for, and is not kept on the event.
+    """
+    __slots__ = (
+        'pevent',       # tuple containing netplan version of event
+        'extra',        # lines to append to the netplan version of event
+        'verbose',
+        '_uid',
+        'dtstart',
+        'dtend',
+        'summary',
+        'description',
+        'location',
+        'transp',
+        'rrules',       # (RRULE value, rrule parameters) from the R lines
+        'exdates',
+        'warnings',     # (early, late) warning times from the entry line
+        'text',         # VEVENT text, when the event came from a cache
+        '_hash',
+        '_script',      # plan2ics script line that is out of date
+    )
+
+    def __init__(self, event, verbose=False):
         self.pevent = event
         self.verbose = verbose
         self.extra = []
-        self._load_plan()
+        self._uid = None
+        self.summary = None
+        self.description = None
+        self.location = None
+        self.rrules = []
+        self.exdates = []
+        self.warnings = (None, None)
+        self.text = None
+        self._script = None
+        with planstats.timed('parse'):
+            self._load_plan()
+
+    def __getstate__(self):
+        # datetimes are stored without their timezone, dayplan puts it back
+        state = dict((name, getattr(self, name)) for name in self.__slots__)
+        for name in ('dtstart', 'dtend'):
+            if isinstance(state[name], datetime.datetime):
+                state[name] = state[name].replace(tzinfo=None)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
 
     @property
     def uid(self):
@@ -92,21 +698,173 @@ class Event(object):
 
     @property
     def hash(self):
-        return hashlib.md5(self.pevent[0]).hexdigest()
+        """Fingerprint of the whole entry, apart from the plan2ics script line.
+
+        Blank lines and trailing whitespace are ignored, so the hash only
+        changes when the content of the entry does.
+        """
+        return self._hash
+
+    @property
+    def script(self):
+        """The plan2ics script line for the event."""
+        return 'S\t#plan2ics: version=%s uuid=%s hash=%s' % (
+            script_version, self.uid, self.hash)
 
     @property
     def plan(self):
         if self.pevent:
-            return "%s%s" % (''.join(self.pevent), '\n'.join(self.extra))
+            header, body = self.pevent
+            if self._script:
+                body = body.replace(self._script, self.script, 1)
+            return "%s%s%s" % (header, body, '\n'.join(self.extra))
         else:
             return ''
 
+    @property
+    def vevent(self):
+        """ICS version of event, as a new vobject component."""
+        vevent = vobject.newFromBehavior('vevent').transformToNative()
+        vevent.add('uid').value = self.uid
+        vevent.add('dtstart').value = self.dtstart
+        vevent.add('dtend').value = self.dtend
+        vevent.add('transp').value = self.transp
+        if self.summary is not None:
+            vevent.add('summary').value = self.summary
+        if self.location:
+            vevent.add('location').value = self.location
+        if self.description:
+            vevent.add('description').value = self.description
+        for value, params in self.rrules:
+            vevent.add('rrule').value = value
+        if self.exdates:
+            exdates = self.exdates
+            if not isinstance(self.dtstart, datetime.datetime):
+                exdates = [exdate.date() for exdate in exdates]
+            else:
+                exdates = [exdate.replace(tzinfo=self.dtstart.tzinfo)
+                           for exdate in exdates]
+            vevent.add('exdate').value = exdates
+        return vevent
+
     @property
     def ics(self):
-        if self.vevent:
-            return self.vevent
+        return self.vevent
+
+    def occurrences(self, start, end):
+        """Yield the start of each occurrence that overlaps start..end.
+
+        Times are naive datetimes in the timezone of the event. Recurrences
+        are generated lazily, and daily and weekly rules start from the
+        period just before start rather than from dtstart.
+        """
+        dtstart = _naive(self.dtstart)
+        duration = _naive(self.dtend) - dtstart
+        if not self.rrules:
+            if dtstart < end and (dtstart + duration > start or
+                                  dtstart >= start):
+                yield dtstart
+            return
+        rrule_set = rrule.rruleset()
+        for value, params in self.rrules:
+            rrule_set.rrule(rrule.rrule(
+                dtstart=_skip_periods(params, dtstart, start - duration),
+                **params))
+        excluded = set(self.exdates)
+        for occurrence in rrule_set:
+            if occurrence >= end:
+                break
+            if occurrence in excluded:
+                continue
+            if occurrence + duration > start or occurrence >= start:
+                yield occurrence
+
+    def instance(self, dtstart):
+        """Returns a copy of the event for the occurrence starting at dtstart.
+
+        The copy has no recurrences. Occurrences of repeating events get
+        their own UID, made from the UID of the event and the start time.
+        """
+        event = Event.__new__(Event)
+        for name in self.__slots__:
+            setattr(event, name, getattr(self, name))
+        duration = _naive(self.dtend) - _naive(self.dtstart)
+        if isinstance(self.dtstart, datetime.datetime):
+            event.dtstart = dtstart.replace(tzinfo=self.dtstart.tzinfo)
+            event.dtend = (dtstart + duration).replace(
+                tzinfo=self.dtend.tzinfo)
         else:
-            return ''
+            event.dtstart = dtstart.date()
+            event.dtend = (dtstart + duration).date()
+        event.rrules = []
+        event.exdates = []
+        event.text = None
+        if self.rrules:
+            event._uid = '%s-%s' % (self.uid,
+                                    dtstart.strftime('%Y%m%dT%H%M%S'))
+        return event
+
+    def serialize(self, tzid=None, dtstamp=None):
+        """Returns the event as VEVENT text, without going through vobject.
+
+        The output is the same as vevent.serialize(). tzid is the TZID of
+        the timezone the datetimes are in, or None for UTC. If the event came
+        from a cache, the text stored with it is returned as it is.
+        """
+        if self.text is not None:
+            return self.text
+        if dtstamp is None:
+            dtstamp = datetime.datetime.utcnow()
+        isdate = not isinstance(self.dtstart, datetime.datetime)
+        lines = [
+            'BEGIN:VEVENT',
+            'UID:' + _escape_text(self.uid),
+            _format_datetime('DTSTART', self.dtstart, tzid),
+            _format_datetime('DTEND', self.dtend, tzid),
+        ]
+        if self.description:
+            lines.append('DESCRIPTION:' + _escape_text(self.description))
+        lines.append('DTSTAMP:%04d%02d%02dT%02d%02d%02dZ' % (
+            dtstamp.year, dtstamp.month, dtstamp.day,
+            dtstamp.hour, dtstamp.minute, dtstamp.second))
+        if self.exdates:
+            if isdate:
+                lines.append('EXDATE;VALUE=DATE:' + ','.join(
+                    '%04d%02d%02d' % (d.year, d.month, d.day)
+                    for d in self.exdates))
+            else:
+                # in the timezone of DTSTART, so they match its occurrences
+                tzinfo = self.dtstart.tzinfo
+                values = [_format_datetime('EXDATE', d.replace(tzinfo=tzinfo),
+                                           tzid) for d in self.exdates]
+                lines.append(values[0] + ''.join(
+                    ',' + value.rsplit(':', 1)[1] for value in values[1:]))
+        if self.location:
+            lines.append('LOCATION:' + _escape_text(self.location))
+        for value, params in self.rrules:
+            lines.append('RRULE:' + value)
+        if self.summary is not None:
+            lines.append('SUMMARY:' + _escape_text(self.summary))
+        lines.append('TRANSP:' + _escape_text(self.transp))
+        lines.append('END:VEVENT')
+        return ''.join(_fold(line) for line in lines)
+
+    @property
+    def rruleset(self):
+        """The recurrences of the event, or None if it does not repeat."""
+        if not (self.rrules or self.exdates):
+            return None
+        dtstart = self.dtstart
+        if isinstance(dtstart, datetime.datetime):
+            dtstart = dtstart.replace(tzinfo=None)
+        else:
+            dtstart = datetime.datetime.combine(dtstart, datetime.time(0))
+        rrule_set = rrule.rruleset()
+        for value, params in self.rrules:
+            rrule_set.rrule(rrule.rrule(dtstart=dtstart, **params))
+        for exdate in self.exdates:
+            rrule_set.exdate(exdate)
+        return rrule_set
 
     def _escape(self, text):
         """Returns the given text with everything above ASCII 128 removed."""
@@ -114,39 +872,37 @@ class Event(object):
         return text
 
     def _load_plan(self):
-        dt = datetime_rx.match(self.pevent[0])
-        dt_start = None
+        dt_start = decode_header(self.pevent[0])
         dt_end = None
-        dt_until = None
-        time = dt.group('time')
-        if time == '99:99:99':
+        allday = not isinstance(dt_start, datetime.datetime)
+        if allday:
             # there is no alarm trigger time
             # I will treat these as transparent, all-day events
-            dt_start = datetime.datetime.strptime('%s' % dt.group('date'),
-                                                  '%m/%d/%Y').date()
-            self.vevent.add('dtstart').value = dt_start
             dt_end = dt_start + one_day
-            self.vevent.add('transp').value = 'TRANSPARENT'
+            self.transp = 'TRANSPARENT'
         else:
             # we have a trigger time, and will use it for the end time
             # until something better comes along
-            dt_start = datetime.datetime.strptime(
-                '%s %s' % (dt.group('date'), time),
-                '%m/%d/%Y %H:%M:%S')
-            self.vevent.add('dtstart').value = dt_start
-            self.vevent.add('transp').value = 'OPAQUE'
+            self.transp = 'OPAQUE'
+        lines = self.pevent[1].split('\n')
+        # the rest of the entry line: length, early and late warning, flags
+        duration, early, late = decode_fields(lines[0])
+        if duration:
+            dt_end = dt_start + duration
+        self.warnings = (early, late)
         description = []
-        rrule_set = None
         location = None
-        for line in re.split(r'\n', self.pevent[1]):
+        script = None
+        fingerprint = hashlib.md5(self.pevent[0])
+        for line in lines:
             if not line:
                 continue
+            if '#plan2ics:' not in line:
+                fingerprint.update(line.rstrip() + '\n')
             if line[0] == 'N':
                 m = note_rx.match(line)
                 if m:
-                    self.vevent.add('summary').value = self._escape(
-                        m.group('message')
-                    )
+                    self.summary = self._escape(m.group('message'))
                     if '@' in m.group('message'):
                         location = m.group('message').split('@', 1)[-1]
             elif line[0] == 'M':
@@ -159,118 +915,167 @@ class Event(object):
             elif line[0] == 'R':
                 m = repeat_rx.match(line)
                 if m:
-                    rrlist = []
-                    repeat_days = None
-                    if not rrule_set:
-                        rrule_set = rruleset()
-                    if not m.group('delete_secs') == '0':
-                        dt_until = epoch + datetime.timedelta(
-                            seconds=int(m.group('delete_secs'))
-                        )
-                        rrlist.append('UNTIL=%s' % dt_until)
-                    if not m.group('trigger_secs') == '0':
-                        repeat_days = int(m.group('trigger_secs')) / 86400
-                        rrlist.append('INTERVAL=%s' % repeat_days)
-                    if m.group('yearly') == '1':
-                        rrlist.append('FREQ=YEARLY')
-                    elif not m.group('monthdaymap') == '0':
-                        rrlist.append('FREQ=MONTHLY')
-                        monthdaymap = int(m.group('monthdaymap'))
-                        daylist = []
-
-                        for i in range(1, 31):
-                            if monthdaymap & (1 << i):
-                                daylist.append(str(i))
-
-                        # bit 0 is set, so it is the last day of the month
-                        if monthdaymap & 1:
-                            daylist.append('-1')
-                        if daylist:
-                            rrlist.append('BYMONTHDAY=%s' % ','.join(daylist))
-
-                    elif not m.group('weekdaymap') == '0':
-                        days = []
-                        weeks = []
-                        weekdaymap = int(m.group('weekdaymap'))
-                        for i in range(7):
-                            if weekdaymap & (1 << i):
-                                days.append(weekday[i])
-                        for i in range(8, 14):
-                            if weekdaymap & (1 << i):
-                                weeks.append(weeknumber[i - 8])
-                        if weeks:
-                            rrlist.append('FREQ=MONTHLY')
-                            if days:
-                                rrlist.append('BYDAY=%s' % ','.join(days))
-                            if weeks:
-                                rrlist.append('BYSETPOS=%s' % ','.join(weeks))
-                        else:
-                            rrlist.append('FREQ=WEEKLY')
-                            if days:
-                                rrlist.append('BYDAY=%s' % ','.join(days))
-                    else:
-                        rrlist.append('FREQ=DAILY')
+                    repeat = translate_repeat(
+                        int(m.group('trigger_secs')),
+                        int(m.group('delete_secs')),
+                        int(m.group('weekdaymap')),
+                        int(m.group('monthdaymap')),
+                        m.group('yearly') == '1',
+                        allday)
                     if self.verbose:
-                        print "days %s rrlist %s" % ('', ';'.join(rrlist))
-                    rrule_set.rrule(rrulestr(';'.join(rrlist)))
+                        print "days %s rrule %s" % ('', repeat[0])
+                    self.rrules.append(repeat)
+                    planstats.count('recurrences')
             elif line[0] == 'E':
                 m = exception_rx.match(line)
                 if m:
-                    if not rrule_set:
-                        rrule_set = rruleset()
-                    rrule_set.exdate(datetime.datetime.strptime(
-                        '%s' % m.group('date'), '%m/%d/%Y')
-                    )
+                    # the occurrence of a timed repeat on that day is
+                    # the one taken out, so use the time of the entry
+                    date = decode_date(m.group('date'))
+                    self.exdates.append(datetime.datetime.combine(
+                        date, _naive(dt_start).time()))
             elif line[0] == 'S':
                 s = script_rx.match(line)
                 if s:
                     self._uid = s.group('uid')
+                    script = s
             elif line[0] == 'G':
                 continue
-            else:
-                m = duration_rx.match(line)
-                if m:
-                    duration = datetime.timedelta(
-                        hours=int(m.group('hours')),
-                        minutes=int(m.group('minutes')),
-                        seconds=int(m.group('seconds'))
-                    )
-                    if duration:
-                        dt_end = dt_start + duration
-        if location:
-            self.vevent.add('location').value = location
+        self.dtstart = dt_start
         if dt_end:
-            self.vevent.add('dtend').value = dt_end
+            self.dtend = dt_end
         else:
-            self.vevent.add('dtend').value = dt_start
+            self.dtend = dt_start
+        self.location = location
         if description:
-            self.vevent.add('description').value = ' '.join(description)
-        if rrule_set:
+            self.description = ' '.join(description)
+        if self.rrules or self.exdates:
             if self.verbose:
                 print "plan event %s" % (self.plan)
-            self.vevent.rruleset = rrule_set
+        self._hash = fingerprint.hexdigest()
+        if script:
+            # rewrite script lines from older versions, or for changed entries
+            if (int(script.group('version')) != script_version or
+                    script.group('hash') != self.hash):
+                self._script = script.group(0)
         if not self._uid:
             # generate a UID and save it in the netplan data
             self._uid = uuid.uuid3(uuid.NAMESPACE_OID,
                                    '%s %s' % (dt_start, ' '.join(description))
                                    )
-            self.extra.append('S\t#plan2ics: version=%s uuid=%s hash=%s\n' %
-                              (0, self.uid, self.hash))
+            self.extra.append(self.script + '\n')
         return
 
 
+class EventIndex(object):
+    """Answers which events happen in a window, without scanning them all.
+
+    Single events are kept sorted by start time. The occurrences of
+    repeating events are worked out a year at a time, the first time a
+    window touches that year, and kept sorted in the same way. Times are
+    naive datetimes in the timezone of the events.
+    """
+
+    def __init__(self, events):
+        self.events = []
+        self.repeating = []
+        singles = []
+        self.single_span = datetime.timedelta(0)
+        self.repeating_span = datetime.timedelta(0)
+        for position, event in enumerate(events):
+            dtstart = _naive(event.dtstart)
+            duration = _naive(event.dtend) - dtstart
+            self.events.append(event)
+            if event.rrules:
+                self.repeating.append(position)
+                self.repeating_span = max(self.repeating_span, duration)
+            else:
+                singles.append((dtstart, position, duration))
+                self.single_span = max(self.single_span, duration)
+        singles.sort()
+        self.singles = ([dtstart for dtstart, position, duration in singles],
+                        [(position, duration)
+                         for dtstart, position, duration in singles])
+        self.years = {}
+
+    def _year(self, year):
+        """The sorted occurrences of the repeating events starting in year."""
+        occurrences = self.years.get(year)
+        if occurrences is None:
+            start = datetime.datetime(year, 1, 1)
+            if year < datetime.MAXYEAR:
+                end = datetime.datetime(year + 1, 1, 1)
+            else:
+                end = datetime.datetime.max
+            found = []
+            for position in self.repeating:
+                event = self.events[position]
+                duration = _naive(event.dtend) - _naive(event.dtstart)
+                for occurrence in event.occurrences(start, end):
+                    if occurrence >= start:
+                        found.append((occurrence, position, duration))
+            found.sort()
+            occurrences = self.years[year] = (
+                [occurrence for occurrence, position, duration in found],
+                [(position, duration)
+                 for occurrence, position, duration in found])
+        return occurrences
+
+    def _search(self, occurrences, span, start, end):
+        starts, entries = occurrences
+        try:
+            earliest = start - span
+        except OverflowError:
+            earliest = datetime.datetime.min
+        found = []
+        for i in xrange(bisect.bisect_left(starts, earliest),
+                        bisect.bisect_left(starts, end)):
+            position, duration = entries[i]
+            if starts[i] + duration > start or starts[i] >= start:
+                found.append((starts[i], position))
+        return found
+
+    def between(self, start, end):
+        """Returns (dtstart, event) for each occurrence overlapping start..end.
+
+        They are in the same order as expand() gives them.
+        """
+        found = self._search(self.singles, self.single_span, start, end)
+        if self.repeating and start < end:
+            try:
+                first = (start - self.repeating_span).year
+            except OverflowError:
+                first = datetime.MINYEAR
+            last = (end - datetime.timedelta.resolution).year
+            for year in xrange(first, last + 1):
+                found.extend(self._search(self._year(year),
+                                          self.repeating_span, start, end))
+        found.sort()
+        return [(dtstart, self.events[position])
+                for dtstart, position in found]
+
+
 class dayplan(object):
-    calendar = None
     timezone = None
+    tzid = None
     events = None
+    current_events = None
     verbose = False
 
-    def __init__(self, input=None, date_threshold_delta=None, verbose=False):
+    def __init__(self, input=None, date_threshold_delta=None, verbose=False,
+                 cache=None, timezone=None):
         self.events = []
-        self.calendar = vobject.iCalendar()
-        self.timezone = PyICU.ICUtzinfo.getDefault()
-        tz = self.calendar.add('vtimezone')
-        tz.settzinfo(self.timezone)
+        self.cache = cache
+        self._cache_keys = set()
+        self.current_events = []
+        self._calendar = None
+        self._index = None
+        # the local timezone from ICU, unless another one is given
+        self.timezone = timezone or PyICU.ICUtzinfo.getDefault()
+        tzid = vobject.icalendar.TimezoneComponent.registerTzinfo(
+            self.timezone)
+        if tzid:
+            self.tzid = tzid.encode('utf-8')
         self.verbose = verbose
         self.date_threshold_delta = date_threshold_delta
         if date_threshold_delta:
@@ -279,50 +1084,460 @@ class dayplan(object):
         if input:
             self._load(input)
 
+    @property
+    def vtimezone(self):
+        """The VTIMEZONE for the years of the current events."""
+        return vtimezone(self.timezone, self.tzid,
+                         self._span(self.current_events))
+
+    def _span(self, events):
+        # the years of the events with a time, the others are not in the
+        # timezone. An empty calendar gets the default years.
+        timed = [pevent for pevent in events
+                 if isinstance(pevent.dtstart, datetime.datetime)]
+        return event_years(timed) or event_years(events)
+
+    @property
+    def calendar(self):
+        """The vobject calendar, built from the current events on first use."""
+        if self._calendar is None:
+            self._calendar = vobject.iCalendar()
+            self._calendar.add(self.vtimezone)
+            for pevent in self.current_events:
+                self._calendar.add(pevent.vevent)
+        return self._calendar
+
+    def between(self, start, end):
+        """Returns (dtstart, event) for each occurrence overlapping start..end.
+
+        start and end are naive datetimes in the timezone of the calendar.
+        The current events are indexed on the first query, so later queries
+        against the same calendar only look at the events near the window.
+        Use event.instance(dtstart) for a copy of a single occurrence.
+        """
+        if self._index is None:
+            self._index = EventIndex(self.current_events)
+        return self._index.between(start, end)
+
     def _load(self, fh):
-        # split the input file based on the lines that start with a date
-        entries = re.split(r'(\d+/\d+/\d+\s+\d+:\d+:\d+)', fh.read())
-
-        # now grab each event. That is the date, and the data after it
-        for plan_event in zip(entries[1::2], entries[2::2]):
-            vevent = self.calendar.add('vevent')
-            pevent = Event(vevent, plan_event, self.verbose)
-            vevent.add('uid').value = pevent.uid
+        self._add_events(self._read_events(fh))
+
+    def load_split(self, file, parts, pool=None):
+        """Load file by parsing parts byte ranges of it in worker processes.
+
+        The ranges start on entry lines, and the events are added in the
+        same order as in the file. A multiprocessing pool may be passed in,
+        otherwise one with parts processes is used.
+        """
+        own_pool = pool is None
+        if own_pool:
+            pool = multiprocessing.Pool(parts)
+        try:
+            chunks = pool.imap(_read_range, [
+                (file, start, end, self.verbose)
+                for start, end in split_ranges(file, parts)])
+            self._add_events(self._place_events(
+                pevent for chunk in chunks for pevent in chunk))
+        finally:
+            if own_pool:
+                pool.close()
+                pool.join()
+
+    def _add_events(self, events):
+        self._calendar = None
+        self._index = None
+        for pevent, current in events:
             self.events.append(pevent)
+            if current:
+                self.current_events.append(pevent)
+
+    def _read_events(self, fh):
+        """Yield (event, current) for each entry in fh as soon as it is read.
+
+        current is False when the event falls outside the date threshold.
+        """
+        # grab each event as it is read: the date, and the data after it
+        entries = planstats.timed_iter('read', read_entries(fh))
+        if self.cache is None:
+            events = (Event(plan_event, self.verbose)
+                      for plan_event in entries)
+        else:
+            events = (self._cached_event(plan_event)
+                      for plan_event in entries)
+        return self._place_events(events)
 
+    def _cached_event(self, plan_event):
+        key = cache_key(plan_event, self.tzid)
+        self._cache_keys.add(key)
+        pevent = self.cache.get(key)
+        if pevent is None:
+            pevent = Event(plan_event, self.verbose)
+            self.cache[key] = pevent
+        return pevent
+
+    def prune_cache(self):
+        """Remove the cached entries that were not in the last file read."""
+        for key in list(self.cache.keys()):
+            if key not in self._cache_keys:
+                del self.cache[key]
+
+    def _place_events(self, events):
+        """Yield (event, current) for each event, see _read_events()."""
+        events = iter(events)
+        while True:
+            # the date threshold is checked a batch of events at a time
+            batch = list(itertools.islice(events, threshold_batch))
+            if not batch:
+                break
             if self.date_threshold_delta:
-                if vevent.rruleset:
-                    # If this is a repeating event,
-                    # and there is no valid date after the threshold date,
-                    # remove the event.
-                    if not vevent.rruleset.after(self.date_threshold):
-                        self.calendar.remove(vevent)
-                else:
-                    # Check if the end date is after the threshold date.
-                    vdtend = datetime.datetime.combine(
-                        vevent.dtend.value, datetime.time(0)
-                    )
-                    dtdiff = datetime.datetime.now() - vdtend
-                    if dtdiff > self.date_threshold_delta:
-                        # remove the event if it is too far in the past
-                        self.calendar.remove(vevent)
-            # put all the datetimes into the current timezone
-            # even if the object has been removed from the calendar.
-            if(isinstance(vevent.dtstart.value, datetime.datetime)):
-                vevent.dtstart.value = vevent.dtstart.value.replace(
-                    tzinfo=self.timezone
-                )
-            if(isinstance(vevent.dtend.value, datetime.datetime)):
-                vevent.dtend.value = vevent.dtend.value.replace(
-                    tzinfo=self.timezone
-                )
+                with planstats.timed('filter', len(batch)):
+                    current = filter_threshold(batch, self.date_threshold)
+                planstats.count('dropped', current.count(False))
+            else:
+                current = [True] * len(batch)
+            with planstats.timed('timezone', len(batch)):
+                for pevent in batch:
+                    # put all the datetimes into the current timezone
+                    # even if the object has been removed from the calendar.
+                    if(isinstance(pevent.dtstart, datetime.datetime)):
+                        pevent.dtstart = pevent.dtstart.replace(
+                            tzinfo=self.timezone)
+                    if(isinstance(pevent.dtend, datetime.datetime)):
+                        pevent.dtend = pevent.dtend.replace(
+                            tzinfo=self.timezone)
+            for pevent, keep in zip(batch, current):
+                yield pevent, keep
 
     def save_plan(self, fh):
-        for event in self.events:
-            fh.write(event.plan)
+        with planstats.timed('save', len(self.events)):
+            for event in self.events:
+                fh.write(event.plan)
+
+    def pprint(self, window=None):
+        return u''.join(self.iter_ics(window=window))
+
+    def expand(self, start, end, events=None):
+        """Yield a copy of every occurrence that overlaps start..end.
+
+        The occurrences are in order of their start time, see expand().
+        """
+        if events is None:
+            events = self.current_events
+        for dtstart, pevent in expand(events, start, end):
+            yield pevent.instance(dtstart)
+
+    def busy(self, start, end, events=None):
+        """Yield the (start, end) periods in start..end taken up by events.
+
+        Only OPAQUE events count, so all-day entries are left out. The
+        periods are merged where they overlap, cut to the window and given
+        in UTC.
+        """
+        if events is None:
+            events = self.current_events
+        events = [pevent for pevent in events if pevent.transp == 'OPAQUE']
+        periods = []
+        for dtstart, pevent in expand(events, start, end):
+            dtend = dtstart + (_naive(pevent.dtend) - _naive(pevent.dtstart))
+            periods.append((max(dtstart, start), min(dtend, end)))
+        for period in merge_periods(periods):
+            if period[0] < period[1]:
+                yield tuple(value.replace(tzinfo=self.timezone).astimezone(
+                    vobject.icalendar.utc) for value in period)
+
+    def iter_freebusy(self, window, input=None):
+        """Yield a calendar holding a VFREEBUSY for window, as unicode chunks.
+
+        See busy() for the periods, and iter_ics() for input.
+        """
+        header = vobject.iCalendar().serialize()
+        yield unicode(header[:-len(ics_trailer)], 'utf-8')
+        if input:
+            events = (pevent for pevent, current in self._read_events(input)
+                      if current)
+        else:
+            events = self.current_events
+        start, end = [value.replace(tzinfo=self.timezone).astimezone(
+            vobject.icalendar.utc) for value in window]
+        dtstamp = datetime.datetime.utcnow().replace(
+            tzinfo=vobject.icalendar.utc)
+        lines = [
+            'BEGIN:VFREEBUSY',
+            'UID:%s' % uuid.uuid3(uuid.NAMESPACE_OID, 'freebusy %s %s' % (
+                start.isoformat(), end.isoformat())),
+            _format_datetime('DTSTAMP', dtstamp),
+            _format_datetime('DTSTART', start),
+            _format_datetime('DTEND', end),
+        ]
+        for period in self.busy(window[0], window[1], list(events)):
+            lines.append('FREEBUSY:%s/%s' % tuple(
+                _format_datetime('', value).split(':', 1)[1]
+                for value in period))
+        lines.append('END:VFREEBUSY')
+        yield unicode(''.join(_fold(line) for line in lines), 'utf-8')
+        yield unicode(ics_trailer)
+
+    def iter_ics(self, input=None, window=None):
+        """Yield the calendar as unicode chunks, one VEVENT at a time.
+
+        With an input file handle the events are converted as they are read
+        and are not kept on the dayplan, so memory use does not depend on the
+        size of the file. Without one, the events already loaded are used.
+        With a (start, end) window, every occurrence in the window is
+        written as an event of its own, instead of writing the recurrences.
+
+        The VTIMEZONE only has the transitions for the years the events
+        happen in, or the years of the window. Events read from input are
+        not known when it is written, so without a window it has the
+        default years.
+        """
+        span = None
+        if input:
+            events = (pevent for pevent, current in self._read_events(input)
+                      if current)
+        else:
+            events = self.current_events
+            span = self._span(events)
+        if window:
+            # the occurrences are only generated as they are written
+            events = self.expand(window[0], window[1], list(events))
+            span = (window[0].year, window[1].year)
+        yield self._ics_header(span)
+        dtstamp = datetime.datetime.utcnow()
+        for pevent in events:
+            with planstats.timed('serialize'):
+                text = pevent.serialize(self.tzid, dtstamp)
+            if self.cache is not None and pevent.text is None and not window:
+                # the DTSTAMP of the first conversion is kept, which is the
+                # last time the entry was changed
+                pevent.text = text
+                self.cache[cache_key(pevent.pevent, self.tzid)] = pevent
+            yield unicode(text.translate(translate_map), 'utf-8')
+        yield unicode(ics_trailer)
+
+    def _ics_header(self, span=None):
+        """The start of the calendar, with a VTIMEZONE for the years span.
 
-    def pprint(self):
-        return unicode(self.calendar.serialize().translate(translate_map), 'utf-8')
+        With a cache, the header is kept in it as well, so later runs do
+        not have to work out the transitions again.
+        """
+        if self.cache is None:
+            return ics_header(self.timezone, self.tzid, span)
+        key = cache_key(('VTIMEZONE', repr(span)), self.tzid)
+        self._cache_keys.add(key)
+        header = self.cache.get(key)
+        if header is None:
+            header = ics_header(self.timezone, self.tzid, span)
+            self.cache[key] = header
+        return header
+
+    def event_ics(self, pevent):
+        """Returns a calendar holding only pevent, as unicode."""
+        text = pevent.serialize(self.tzid)
+        return u''.join([self._ics_header(self._span([pevent])),
+                         unicode(text.translate(translate_map), 'utf-8'),
+                         unicode(ics_trailer)])
+
+    def write_ics(self, out, input=None, window=None):
+        """Write the calendar to out, encoded as UTF-8, as it is generated."""
+        for chunk in self.iter_ics(input, window):
+            chunk = chunk.encode('utf-8')
+            planstats.count('bytes out', len(chunk))
+            out.write(chunk)
+
+
+def convert_file(file, date_threshold_delta=None, verbose=False,
+                 do_save=False, parts=None, cache_dir=None, window=None,
+                 freebusy=False, zone=None):
+    """Convert one dayplan file.
+
+    With parts, the file is split into that many ranges which are parsed in
+    worker processes, see dayplan.load_split(). With cache_dir, converted
+    entries are kept in an on-disk cache there and only the entries that
+    changed since the last run are converted again. With a (start, end)
+    window, the occurrences in it are written instead of the recurrences.
+    With freebusy, a VFREEBUSY for window is written instead of the events.
+    zone is the name of the timezone to use instead of the local one.
+
+    Returns (ics, plan, mtime, seconds). plan is the text to save back into
+    the file, or None when do_save is not set. mtime is the modification
+    time of the file when it was read.
+    """
+    start = time.time()
+    mtime = os.stat(file).st_mtime
+    cache = None
+    if cache_dir and not parts:
+        cache = open_cache(cache_dir, file)
+    timezone = zone and zoneinfo(zone)
+    try:
+        if parts:
+            c = dayplan(None, date_threshold_delta, verbose,
+                        timezone=timezone)
+            c.load_split(file, parts)
+        else:
+            with open(file, mode='r') as fh:
+                c = dayplan(fh, date_threshold_delta, verbose, cache,
+                            timezone)
+        if freebusy:
+            ics = u''.join(c.iter_freebusy(window))
+        else:
+            ics = c.pprint(window)
+        if planstats.enabled:
+            planstats.count('bytes out', len(ics.encode('utf-8')))
+        if cache is not None:
+            c.prune_cache()
+    finally:
+        if cache is not None:
+            cache.close()
+    plan = None
+    if do_save:
+        buf = StringIO()
+        c.save_plan(buf)
+        plan = buf.getvalue()
+    return ics, plan, mtime, time.time() - start
+
+
+def _convert_file(args):
+    # Pool.imap only passes a single argument
+    return convert_file(*args)
+
+
+def save_plan_file(file, plan, mtime=None):
+    """Replace the contents of file with plan.
+
+    The new contents are written to a temporary file which is renamed over
+    the original, so readers never see a partly written file. Nothing is
+    written, and False is returned, if the file has been modified since
+    mtime.
+    """
+    if mtime is not None and os.stat(file).st_mtime != mtime:
+        return False
+    write_file(file, plan)
+    return True
+
+
+def write_file(file, data):
+    """Replace file with data by renaming a temporary file over it.
+
+    The permissions of an existing file are kept, a new file gets the
+    usual permissions for the umask.
+    """
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file)))
+    try:
+        with os.fdopen(fd, 'w') as fh:
+            fh.write(data)
+        if os.path.exists(file):
+            shutil.copymode(file, temp)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp, 0666 & ~umask)
+        os.rename(temp, file)
+    except:
+        os.unlink(temp)
+        raise
+
+
+def file_signature(file):
+    """Returns what changes when file is written or replaced, or None."""
+    try:
+        st = os.stat(file)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime
+
+
+def watch_changes(files, interval=watch_interval):
+    """Returns an iterator of files in files as they are written or replaced.
+
+    Changes are looked for from the time of the call. inotify is used when
+    pyinotify is installed, otherwise the files are polled with stat()
+    every interval seconds. The directories are watched rather than the
+    files, so files replaced by a rename are still seen.
+    """
+    paths = dict((os.path.abspath(file), file) for file in files)
+    signatures = dict((file, file_signature(file)) for file in files)
+    changed = set()
+    if pyinotify:
+        class Handler(pyinotify.ProcessEvent):
+            def process_default(self, event):
+                if event.pathname in paths:
+                    changed.add(paths[event.pathname])
+        manager = pyinotify.WatchManager()
+        notifier = pyinotify.Notifier(manager, Handler(),
+                                      timeout=int(interval * 1000))
+        for directory in set(os.path.dirname(path) for path in paths):
+            manager.add_watch(directory, pyinotify.IN_CLOSE_WRITE |
+                              pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE)
+
+    def changes():
+        while True:
+            if pyinotify:
+                if notifier.check_events():
+                    notifier.read_events()
+                    notifier.process_events()
+            else:
+                time.sleep(interval)
+                changed.update(files)
+            for file in files:
+                if file not in changed:
+                    continue
+                signature = file_signature(file)
+                if signature is not None and signature != signatures[file]:
+                    signatures[file] = signature
+                    yield file
+            changed.clear()
+    return changes()
+
+
+def watch(files, date_threshold_delta=None, verbose=False, cache_dir=None,
+          window=None, freebusy=False, zone=None, changes=None):
+    """Convert files to FILE.ics, and again each time one of them changes.
+
+    The converted entries of each file are kept between conversions, in
+    the on-disk cache when there is a cache_dir and in memory otherwise,
+    so only the entries that changed are converted again. changes is the
+    iterable of changed files, watch_changes(files) by default.
+    """
+    timezone = zone and zoneinfo(zone)
+    caches = {}
+    for file in files:
+        if cache_dir:
+            caches[file] = open_cache(cache_dir, file)
+        else:
+            caches[file] = {}
+
+    def convert(file):
+        start = time.time()
+        try:
+            with open(file, mode='r') as fh:
+                c = dayplan(fh, date_threshold_delta, verbose, caches[file],
+                            timezone)
+            if freebusy:
+                # without a window, the default one moves on with the days
+                ics = u''.join(c.iter_freebusy(window or freebusy_window()))
+            else:
+                ics = c.pprint(window)
+            c.prune_cache()
+            write_file(file + '.ics', ics.encode('utf-8'))
+        except Exception, e:
+            # keep watching, the file may have been caught half written
+            sys.stderr.write('%s: %s\n' % (file, e))
+            return
+        if verbose:
+            sys.stderr.write('%8.3fs  %s.ics\n' % (time.time() - start, file))
+
+    try:
+        if changes is None:
+            changes = watch_changes(files)
+        for file in files:
+            convert(file)
+        for file in changes:
+            convert(file)
+    finally:
+        if cache_dir:
+            for cache in caches.values():
+                cache.close()
 
 
 def main():
@@ -340,19 +1555,156 @@ def main():
                          default=False,
                          action="store_true",
                          help='re-save the plan file after processing.')
+    optparser.add_option('--stream', dest='stream',
+                         default=False,
+                         action="store_true",
+                         help='write each event as soon as it is converted, '
+                         'without keeping the calendar in memory.')
+    optparser.add_option('-j', '--jobs', dest='jobs',
+                         default=None,
+                         type="int",
+                         help='convert the calendars in N processes.')
+    optparser.add_option('--split', dest='split',
+                         default=None,
+                         type="int",
+                         help='split each calendar into N parts which are '
+                         'parsed in parallel.')
+    optparser.add_option('-c', '--cache', dest='cache_dir',
+                         default=None,
+                         help='keep converted entries in DIR, and only '
+                         'convert the entries that changed since the last '
+                         'run.')
+    optparser.add_option('-e', '--expand', dest='expand',
+                         default=None,
+                         metavar='FROM..TO',
+                         help='write every occurrence between the dates '
+                         'FROM..TO (YYYY-MM-DD) as an event of its own.')
+    optparser.add_option('--freebusy', dest='freebusy',
+                         default=False,
+                         action="store_true",
+                         help='write only the busy times, as a VFREEBUSY. '
+                         'The window is taken from --expand, or is the next '
+                         '%d weeks.' % freebusy_weeks)
+    optparser.add_option('--watch', dest='watch',
+                         default=False,
+                         action="store_true",
+                         help='keep running, and write each calendar to '
+                         'CALENDAR.ics every time it changes.')
+    optparser.add_option('-z', '--timezone', dest='zone',
+                         default=None,
+                         help='write the times in the timezone called ZONE, '
+                         'from the zoneinfo files, instead of the local '
+                         'timezone from ICU.')
+    optparser.add_option('--stats', dest='stats',
+                         default=None,
+                         action="store_const",
+                         const='text',
+                         help='print the time taken by each stage, and how '
+                         'many entries, recurrences and bytes went through '
+                         'it, to stderr.')
+    optparser.add_option('--stats-json', dest='stats',
+                         action="store_const",
+                         const='json',
+                         help='the same as --stats, written as JSON.')
 
     (opts, args) = optparser.parse_args()
+    if opts.stream and opts.do_save:
+        optparser.error('--stream cannot be used with --save')
+    if opts.stream and (opts.jobs or opts.split):
+        optparser.error('--stream cannot be used with --jobs or --split')
+    if opts.jobs and opts.split:
+        optparser.error('--jobs cannot be used with --split')
+    if opts.watch and (opts.do_save or opts.stream or opts.jobs or
+                       opts.split):
+        optparser.error('--watch cannot be used with --save, --stream, '
+                        '--jobs or --split')
+    if opts.stats and (opts.jobs or opts.split):
+        # the work done in the worker processes would not be counted
+        optparser.error('--stats cannot be used with --jobs or --split')
+    window = None
+    if opts.expand:
+        try:
+            window = parse_window(opts.expand)
+        except ValueError, e:
+            optparser.error(str(e))
+    elif opts.freebusy and not opts.watch:
+        window = freebusy_window()
+    if opts.zone:
+        try:
+            zoneinfo(opts.zone)
+        except ValueError, e:
+            optparser.error(str(e))
     date_threshold_delta = None
     if opts.weeks:
         date_threshold_delta = datetime.timedelta(weeks=opts.weeks)
 
+    if not opts.stats:
+        convert(opts, args, window, date_threshold_delta)
+        return
+    stats = planstats.Stats()
+    planstats.subscribe(stats)
+    try:
+        with planstats.timed('total', len(args)):
+            convert(opts, args, window, date_threshold_delta)
+    finally:
+        planstats.unsubscribe(stats)
+        sys.stderr.write(stats.report(opts.stats) + '\n')
+
+
+def convert(opts, args, window, date_threshold_delta):
+    """Convert the calendars in args, as the options of main() say."""
+    if opts.watch:
+        try:
+            watch(args, date_threshold_delta, opts.verbose, opts.cache_dir,
+                  window, opts.freebusy, opts.zone)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if opts.jobs:
+        pool = multiprocessing.Pool(opts.jobs)
+        results = pool.imap(_convert_file, [
+            (file, date_threshold_delta, opts.verbose, opts.do_save, None,
+             opts.cache_dir, window, opts.freebusy, opts.zone)
+            for file in args])
+        timings = []
+        # imap returns the results in the same order as the files
+        for file, (ics, plan, mtime, seconds) in zip(args, results):
+            print(("%s" % ics))
+            if opts.do_save and not save_plan_file(file, plan, mtime):
+                sys.stderr.write('%s changed while converting, not saved\n'
+                                 % file)
+            timings.append((file, seconds))
+        pool.close()
+        pool.join()
+        for file, seconds in timings:
+            sys.stderr.write('%8.3fs  %s\n' % (seconds, file))
+        return
+
     for file in args:
-        with open(file, mode='r') as fh:
-            c = dayplan(fh, date_threshold_delta, opts.verbose)
-        print(("%s" % c.pprint()))
+        if opts.stream:
+            cache = None
+            if opts.cache_dir:
+                cache = open_cache(opts.cache_dir, file)
+            c = dayplan(None, date_threshold_delta, opts.verbose, cache,
+                        opts.zone and zoneinfo(opts.zone))
+            with open(file, mode='r') as fh:
+                if opts.freebusy:
+                    for chunk in c.iter_freebusy(window, fh):
+                        sys.stdout.write(chunk.encode('utf-8'))
+                else:
+                    c.write_ics(sys.stdout, fh, window)
+            sys.stdout.write('\n')
+            if cache is not None:
+                c.prune_cache()
+                cache.close()
+            continue
+        ics, plan, mtime, seconds = convert_file(
+            file, date_threshold_delta, opts.verbose, opts.do_save,
+            opts.split, opts.cache_dir, window, opts.freebusy, opts.zone)
+        print(("%s" % ics))
         if opts.do_save:
-            with open(file, mode='w+') as fh:
-                c.save_plan(fh)
+            save_plan_file(file, plan)
 
 if __name__ == '__main__':
     main()
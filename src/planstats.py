@@ -0,0 +1,166 @@
+#    planstats.py
+#    Timings and counts for the stages of a conversion or upload.
+#
+#    Copyright (c) 2009, James Mitchell
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Timings and counts for the stages of a conversion or upload.
+
+plan2ics and upload2davical report what they do with timed() and
+count(). Nothing is recorded until a hook subscribes, and until then
+each of those calls only tests enabled. A hook is called as
+
+    hook(stage, count, wall, cpu)
+
+with the seconds of wall clock and CPU time the stage took, which are 0
+for plain counts. Stats is a hook that adds it all up:
+
+    stats = planstats.Stats()
+    planstats.subscribe(stats)
+    calendar = plan2ics.dayplan(open('work.plan'))
+    print stats.report()
+"""
+
+import json
+import threading
+import time
+
+# true while any hook is subscribed
+enabled = False
+_hooks = []
+
+
+def subscribe(hook):
+    """Call hook(stage, count, wall, cpu) for everything recorded."""
+    global enabled
+    _hooks.append(hook)
+    enabled = True
+
+
+def unsubscribe(hook):
+    global enabled
+    _hooks.remove(hook)
+    enabled = bool(_hooks)
+
+
+def record(stage, count=1, wall=0.0, cpu=0.0):
+    """Pass a record to every hook."""
+    for hook in list(_hooks):
+        hook(stage, count, wall, cpu)
+
+
+def count(stage, n=1):
+    """Record n more of stage, without a time."""
+    if enabled:
+        record(stage, n)
+
+
+class _Timer(object):
+    __slots__ = ('stage', 'count', 'wall', 'cpu')
+
+    def __init__(self, stage, count):
+        self.stage = stage
+        self.count = count
+
+    def __enter__(self):
+        self.wall = time.time()
+        self.cpu = time.clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        record(self.stage, self.count, time.time() - self.wall,
+               time.clock() - self.cpu)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+_null_timer = _NullTimer()
+
+
+def timed(stage, count=1):
+    """Returns a context manager which records how long its block takes."""
+    if not enabled:
+        return _null_timer
+    return _Timer(stage, count)
+
+
+def timed_iter(stage, iterable):
+    """Yield from iterable, recording the time taken by each item.
+
+    Returns iterable itself when nothing is subscribed.
+    """
+    if not enabled:
+        return iterable
+    return _timed_iter(stage, iter(iterable))
+
+
+def _timed_iter(stage, iterator):
+    while True:
+        wall = time.time()
+        cpu = time.clock()
+        try:
+            item = iterator.next()
+        except StopIteration:
+            return
+        record(stage, 1, time.time() - wall, time.clock() - cpu)
+        yield item
+
+
+class Stats(object):
+    """A hook which totals the records for each stage.
+
+    The CPU time is that of the whole process, so stages run in several
+    threads at once can add up to more than the wall clock time.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.order = []
+        self.totals = {}
+
+    def __call__(self, stage, count, wall, cpu):
+        with self.lock:
+            total = self.totals.get(stage)
+            if total is None:
+                self.order.append(stage)
+                total = self.totals[stage] = [0, 0.0, 0.0]
+            total[0] += count
+            total[1] += wall
+            total[2] += cpu
+
+    def as_dict(self):
+        """Returns {stage: {'count': n, 'wall': seconds, 'cpu': seconds}}."""
+        return dict((stage, {'count': count, 'wall': wall, 'cpu': cpu})
+                    for stage, (count, wall, cpu) in self.totals.items())
+
+    def report(self, format='text'):
+        """Returns the totals as a table, or as JSON with format='json'."""
+        if format == 'json':
+            return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+        lines = ['%-16s %10s %10s %10s' % ('stage', 'count', 'wall', 'cpu')]
+        for stage in self.order:
+            count, wall, cpu = self.totals[stage]
+            if wall or cpu:
+                lines.append('%-16s %10d %9.3fs %9.3fs'
+                             % (stage, count, wall, cpu))
+            else:
+                lines.append('%-16s %10d' % (stage, count))
+        return '\n'.join(lines)
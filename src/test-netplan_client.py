@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+# Tests are run using nose
+
+from nose.tools import assert_equals
+
+from netplan_client import NetplanClient, NetplanError, escape, unescape
+from netplan_client import CRLF
+from plan2ics import dayplan, read_entries
+from StringIO import StringIO
+import SocketServer
+import socket
+import threading
+
+
+test_calendar = """\
+9/11/2009  99:99:99  0:0:0  0:0:0  0:0:0  ---------- 0 0
+R    0 0 0 0 1
+E    9/11/2010
+N    Yearly event
+M    This is the text
+M    of my \\ YEARLY EVENT
+10/5/2009  12:0:0  1:0:0  0:0:0  0:0:0  ---------- 0 0
+N    Lunch
+10/6/2009  16:0:0  1:30:0  0:0:0  0:0:0  ---------- 0 0
+R    604800 0 0 0 0
+N    Weekly meeting
+"""
+
+
+class NetplanHandler(SocketServer.StreamRequestHandler):
+    # a stand-in for netplan, holding one calendar with an entry a row.
+    # Row requests are only answered once a few are waiting, so a client
+    # which waits for each reply before the next request gets stuck.
+    calendars = {}
+    batch = 8
+    requests = []
+
+    def reply(self, line):
+        self.wfile.write(line + CRLF)
+
+    def handle(self):
+        files = {}
+        waiting = []
+        for line in self.rfile:
+            line = line.rstrip(CRLF)
+            self.requests.append(line)
+            if line == 'q':
+                break
+            elif line.startswith('='):
+                pass
+            elif line == 't0':
+                self.reply('t')
+            elif line.startswith('or'):
+                if line[2:] in self.calendars:
+                    files['3'] = self.calendars[line[2:]]
+                    self.reply('otr3')
+                else:
+                    self.reply('ofr0')
+            elif line.startswith('n'):
+                self.reply('n%s %d' % (line[1:], len(files[line[1:]])))
+            elif line.startswith('r'):
+                file, row = line[1:].split()
+                waiting.append((file, int(row)))
+                if len(waiting) < self.batch and \
+                        int(row) < len(files[file]) - 1:
+                    continue
+                for file, row in waiting:
+                    self.reply('rt%s %d %s' % (file, row,
+                                                escape(files[file][row])))
+                waiting = []
+            elif line.startswith('c'):
+                files.pop(line[1:], None)
+
+
+def serve(calendars):
+    NetplanHandler.calendars = calendars
+    del NetplanHandler.requests[:]
+    server = SocketServer.ThreadingTCPServer(('127.0.0.1', 0),
+                                             NetplanHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def escape_test():
+    for text in ('plain', 'two\nlines\n', 'a \\ backslash', 'a \\n in it'):
+        assert_equals(unescape(escape(text)), text)
+    assert '\n' not in escape('two\nlines\n')
+
+
+def get_calendar_test():
+    rows = ['%s%s' % entry for entry in read_entries(StringIO(test_calendar))]
+    # enough rows for the pipeline to be topped up a few times
+    rows = rows * 100
+    server = serve({'work': rows})
+    try:
+        client = NetplanClient('127.0.0.1', server.server_address[1], 16)
+        client.sock.settimeout(10)
+        lines = list(client.get_calendar('work'))
+        assert_equals(''.join(lines), test_calendar * 100)
+        assert_equals(NetplanHandler.requests[1:4], ['t0', 'orwork', 'n3'])
+        assert_equals(len([request for request in NetplanHandler.requests
+                           if request.startswith('r')]), 300)
+
+        # the rows go straight into the dayplan parser
+        calendar = dayplan(client.get_calendar('work'))
+        assert_equals(len(calendar.events), 300)
+        expected = dayplan(StringIO(test_calendar)).events
+        assert_equals([event.summary for event in calendar.events[:3]],
+                      [event.summary for event in expected])
+        assert_equals(calendar.events[0].description,
+                      expected[0].description)
+        # the calendar was closed after each read
+        assert 'c3' in NetplanHandler.requests
+
+        try:
+            list(client.get_calendar('missing'))
+        except NetplanError:
+            pass
+        else:
+            assert False, 'opened a calendar that does not exist'
+        client.disconnect()
+    finally:
+        server.shutdown()
@@ -5,10 +5,22 @@
 from nose import with_setup
 from nose.tools import assert_equals
 
-from plan2ics import dayplan
+from plan2ics import dayplan, read_entries, convert_file, save_plan_file
+from plan2ics import split_ranges, translate_repeat, filter_threshold
+from plan2ics import parse_window, expand, merge_periods
+from plan2ics import watch, watch_changes, zoneinfo
+from plan2ics import decode_date, decode_header, decode_fields
+from lazymodule import LazyModule
 from StringIO import StringIO
 import datetime
+import gendayplan
+import plan2ics
+import planstats
+import os
 import re
+import sys
+import tempfile
+import vobject
 
 import PyICU
 defaultTZ = PyICU.ICUtzinfo.getDefault()
@@ -239,3 +251,616 @@ N    this event has an 0xa0 char that kills unicode \xa0
     print p.pprint()
     o = p.pprint()
     assert isinstance(o, unicode)
+
+
+def read_entries_test():
+    plan = """o	sa-d-----wb--- 0 0 0 8 20 7
+9/11/2009  99:99:99  0:0:0  0:0:0  0:0:0  ---------- 0 0
+N    First event
+M    at 10/5/2009  12:0:0 in the message
+7/21/2009  16:0:0  1:30:0  0:0:0  0:0:0  ---------- 0 0
+N    Second event
+"""
+    entries = list(read_entries(StringIO(plan)))
+    assert_equals(len(entries), 2)
+    assert_equals(entries[0][0], '9/11/2009  99:99:99')
+    assert_equals(entries[0][1], '  0:0:0  0:0:0  0:0:0  ---------- 0 0\n'
+                  'N    First event\n'
+                  'M    at 10/5/2009  12:0:0 in the message\n')
+    assert_equals(entries[1][0], '7/21/2009  16:0:0')
+
+
+def stream_test():
+    fhandle = StringIO(test_calendar)
+    p = dayplan()
+    chunks = list(p.iter_ics(fhandle))
+    assert_equals(p.events, [])
+    # header, one chunk per event, trailer
+    assert_equals(len(chunks), 8)
+    assert chunks[0].startswith(u'BEGIN:VCALENDAR')
+    assert chunks[1].startswith(u'BEGIN:VEVENT')
+    assert_equals(chunks[-1], u'END:VCALENDAR\r\n')
+    o = re.sub(r'DTSTAMP:\w+\r\n', '', ''.join(chunks[1:]))
+    e = re.sub(r'DTSTAMP:\w+\r\n', '',
+               dayplan(StringIO(test_calendar)).pprint())
+    # the events are not read when the VTIMEZONE is written, so the
+    # stream has the one for the default years
+    assert_equals(o, e[e.index(u'BEGIN:VEVENT'):])
+    assert u'DTSTART:20000101T000000' in chunks[0]
+
+
+def event_record_test():
+    plan = """
+2/14/2009  8:30:0  2:0:0  0:0:0  0:0:0  ---------- 0 0
+R    0 1238198400 64 0 0
+E    2/21/2009
+N    Weekly event on Saturday
+M    Where: the pool
+    """
+    p = dayplan(StringIO(plan))
+    event = p.events[0]
+    assert not hasattr(event, '__dict__')
+    assert_equals(event.summary, 'Weekly event on Saturday')
+    assert_equals(event.location, 'the pool')
+    assert_equals(event.transp, 'OPAQUE')
+    assert_equals(event.exdates, [datetime.datetime(2009, 2, 21, 8, 30)])
+    assert_equals(event.dtend,
+                  datetime.datetime(2009, 2, 14, 10, 30, tzinfo=defaultTZ))
+    assert_equals(event.vevent.summary.value, 'Weekly event on Saturday')
+    assert_equals(event.vevent.uid.value, event.uid)
+
+
+def serialize_conformance_test():
+    # the hand-written serializer must match the vobject output byte for byte
+    plans = [test_calendar, """
+2/14/2009  8:30:0  2:0:0  0:0:0  0:0:0  ---------- 0 0
+R    0 1238198400 64 0 0
+E    2/21/2009
+N    Weekly event on Sat, with a long summary; it needs folding \\ escaping
+M    Where: the pool
+M    \xc3\xa9t\xc3\xa9
+7/21/2009  16:0:0  1:30:0  0:0:0  0:0:0  ---------- 0 0
+R    259200 1286323200 0 0 0
+N    Event at 4pm
+M    A description that is long enough to be folded over more than one
+M    line, with commas, semicolons; and more
+    """]
+    for plan in plans:
+        p = dayplan(StringIO(plan))
+        expected = p.calendar.serialize()
+        dtstamp = re.search(r'DTSTAMP:(\w+)', expected).group(1)
+        dtstamp = datetime.datetime.strptime(dtstamp, '%Y%m%dT%H%M%SZ')
+        header = expected[:expected.index('BEGIN:VEVENT')]
+        o = header + ''.join([event.serialize(p.tzid, dtstamp)
+                              for event in p.current_events])
+        o += 'END:VCALENDAR\r\n'
+        assert_equals(re.sub(r'DTSTAMP:\w+', '', o),
+                      re.sub(r'DTSTAMP:\w+', '', expected))
+
+
+def save_plan_file_test():
+    fd, name = tempfile.mkstemp()
+    os.write(fd, test_calendar)
+    os.close(fd)
+    try:
+        ics, plan, mtime, seconds = convert_file(name, do_save=True)
+        assert_equals(plan.count('#plan2ics'), 6)
+        # the file changed after it was read, so it must not be overwritten
+        os.utime(name, (1000, 1000))
+        assert not save_plan_file(name, plan, mtime)
+        assert_equals(open(name).read(), test_calendar)
+        assert save_plan_file(name, plan, os.stat(name).st_mtime)
+        assert_equals(open(name).read(), plan)
+    finally:
+        os.remove(name)
+
+
+def split_test():
+    fd, name = tempfile.mkstemp()
+    os.write(fd, test_calendar)
+    os.close(fd)
+    try:
+        ranges = split_ranges(name, 3)
+        assert_equals(len(ranges), 3)
+        assert_equals(ranges[0][0], 0)
+        assert_equals(ranges[-1][1], len(test_calendar))
+        for start, end in ranges[1:]:
+            assert re.match(r'\d+/\d+/\d+', test_calendar[start:])
+        p = dayplan()
+        p.load_split(name, 3)
+        e = dayplan(StringIO(test_calendar))
+        assert_equals([event.plan for event in p.events],
+                      [event.plan for event in e.events])
+    finally:
+        os.remove(name)
+
+
+def cache_test():
+    cache = {}
+    p = dayplan(StringIO(test_calendar), cache=cache)
+    o = p.pprint()
+    # the entries and the calendar header
+    assert_equals(len(cache), 7)
+    # a changed entry is converted again, the others come from the cache
+    plan = test_calendar.replace('N    Yearly event', 'N    Yearly event!')
+    p = dayplan(StringIO(plan), cache=cache)
+    cached = [event for event in p.events if event.text is not None]
+    assert_equals(len(cached), 5)
+    assert 'SUMMARY:Yearly event!' in p.pprint()
+    p.prune_cache()
+    assert_equals(len(cache), 7)
+    assert_equals(dayplan(StringIO(test_calendar), cache={}).pprint()[:200],
+                  o[:200])
+
+
+def fingerprint_test():
+    plan = """
+7/21/2009  16:0:0  0:0:0  0:0:0  0:0:0  ---------- 0 0
+N    Event at 4pm
+M    in the office
+S\t#plan2ics: version=0 uuid=fdda999e-6412-325d-84a1-41b04a250aaa \
+hash=044429e29baf2fa7faf9b7336a40a805
+"""
+    event = dayplan(StringIO(plan)).events[0]
+    # the script line is not part of the fingerprint
+    unsaved = dayplan(StringIO(plan.replace(plan.splitlines()[-1], '')))
+    assert_equals(event.hash, unsaved.events[0].hash)
+    changed = dayplan(StringIO(plan.replace('office', 'garden')))
+    assert event.hash != changed.events[0].hash
+    # version 0 script lines are rewritten when the plan is saved
+    assert_equals(event.plan.splitlines()[-1],
+                  'S\t#plan2ics: version=1 '
+                  'uuid=fdda999e-6412-325d-84a1-41b04a250aaa hash=%s'
+                  % event.hash)
+    saved = dayplan(StringIO(event.plan)).events[0]
+    assert_equals(saved.plan, event.plan)
+
+
+def translate_repeat_test():
+    value, params = translate_repeat(259200, 1286323200, 0, 0, False, True)
+    assert_equals(value, 'FREQ=DAILY;INTERVAL=3;UNTIL=20101006')
+    assert_equals(params['interval'], 3)
+    assert_equals(params['until'], datetime.datetime(2010, 10, 6))
+    value, params = translate_repeat(0, 1238198400, 64, 0, False, False)
+    assert_equals(value, 'FREQ=WEEKLY;BYDAY=SA;UNTIL=20090328T000000')
+    # the same R line gives the same, shared, translation
+    assert translate_repeat(0, 0, 8963, 0, False, True) is \
+        translate_repeat(0, 0, 8963, 0, False, True)
+
+
+def memoize_threads_test():
+    import threading
+    calls = []
+
+    @plan2ics.memoize(8)
+    def square(n):
+        calls.append(n)
+        return n * n
+
+    errors = []
+
+    def run():
+        try:
+            for i in range(2000):
+                assert_equals(square(i % 20), (i % 20) ** 2)
+        except Exception, e:
+            errors.append(e)
+    threads = [threading.Thread(target=run) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert_equals(errors, [])
+    # the last results are kept, the older ones dropped
+    calls[:] = []
+    square(19)
+    square(0)
+    assert_equals(calls, [0])
+
+
+def filter_threshold_test():
+    plan = test_calendar + """
+10/5/2009  12:0:0  1:0:0  0:0:0  0:0:0  ---------- 0 0
+R    172800 1286323200 0 0 0
+E    10/7/2009
+N    Daily Event - every 2 days at noon, end 2010
+10/5/2009  99:99:99  0:0:0  0:0:0  0:0:0  ---------- 0 0
+R    0 1254787200 0 0 0
+E    10/5/2009
+N    Daily Event - ends the day after it starts
+2/14/2009  8:30:0  2:0:0  0:0:0  0:0:0  ---------- 0 0
+N    Single event
+"""
+    events = dayplan(StringIO(plan)).events
+    for threshold in (datetime.datetime(2009, 2, 14, 9, 0),
+                      datetime.datetime(2009, 10, 5, 12, 0),
+                      datetime.datetime(2010, 10, 4, 13, 0),
+                      datetime.datetime(2010, 10, 6, 0, 0),
+                      datetime.datetime(2020, 1, 1)):
+        expected = []
+        for event in events:
+            if event.rruleset:
+                expected.append(event.rruleset.after(threshold) is not None)
+            else:
+                expected.append(datetime.datetime.combine(
+                    event.dtend, datetime.time(0)) >= threshold)
+        assert_equals(filter_threshold(events, threshold), expected)
+
+
+def expand_test():
+    plan = """
+10/5/2009  99:99:99  0:0:0  0:0:0  0:0:0  ---------- 0 0
+R    172800 1286323200 0 0 0
+E    10/7/2009
+N    Daily Event - every 2 days, end 2010
+10/6/2009  12:0:0  1:0:0  0:0:0  0:0:0  ---------- 0 0
+N    Single event at noon
+"""
+    start, end = parse_window('2009-10-05..2009-10-10')
+    assert_equals(end, datetime.datetime(2009, 10, 11))
+    cal = dayplan(StringIO(plan))
+    instances = list(cal.expand(start, end))
+    starts = [(e.dtstart.year, e.dtstart.month, e.dtstart.day)
+              for e in instances]
+    # the 7th is an exception
+    assert_equals(starts, [(2009, 10, 5), (2009, 10, 6),
+                           (2009, 10, 9)])
+    assert_equals(instances[0].dtstart, datetime.date(2009, 10, 5))
+    assert_equals(instances[1].dtstart.hour, 12)
+    assert instances[0].uid != instances[2].uid
+    assert not instances[0].rrules
+    assert 'RRULE' not in instances[0].serialize()
+
+    # an E line takes out the occurrence of a timed repeat on its day, the
+    # same one the EXDATE of the RRULE takes out
+    timed = """
+10/5/2009  12:0:0  1:0:0  0:0:0  0:0:0  ---------- 0 0
+R    86400 0 0 0 0
+E    10/7/2009
+N    Daily at noon
+"""
+    cal = dayplan(StringIO(timed))
+    days = [e.dtstart.day for e in cal.expand(start, end)]
+    assert_equals(days, [5, 6, 8, 9, 10])
+    assert_equals([dtstart.day for dtstart, e in cal.between(start, end)],
+                  days)
+    busy = list(cal.busy(start, end))
+    assert_equals(len(busy), 5)
+    zoned = dayplan(StringIO(timed + 'E    10/9/2009\n'),
+                    timezone=zoneinfo('Pacific/Auckland'))
+    assert ('EXDATE;TZID=Pacific/Auckland:20091007T120000,20091009T120000'
+            in zoned.pprint())
+    assert_equals([occurrence.day for occurrence in
+                   cal.events[0].rruleset.between(start, end)], days)
+
+
+def between_test():
+    cal = dayplan(StringIO(test_calendar + """
+10/5/2009  12:0:0  1:0:0  0:0:0  0:0:0  ---------- 0 0
+N    Single event at noon
+12/31/2009  23:0:0  2:0:0  0:0:0  0:0:0  ---------- 0 0
+R    604800 0 0 0 0
+N    Weekly event over midnight
+"""))
+    windows = [(datetime.datetime(2009, 10, 5, 12, 30),
+                datetime.datetime(2009, 10, 5, 13, 0)),
+               (datetime.datetime(2010, 1, 1, 0, 30),
+                datetime.datetime(2010, 1, 1, 0, 45)),
+               (datetime.datetime(2009, 9, 1),
+                datetime.datetime(2011, 3, 1)),
+               (datetime.datetime(2030, 1, 1),
+                datetime.datetime(2030, 1, 2))]
+    for start, end in windows:
+        assert_equals(cal.between(start, end),
+                      list(expand(cal.current_events, start, end)))
+    # the weekly event started the evening before, the all-day events
+    # started at midnight
+    summaries = [event.summary for dtstart, event in cal.between(*windows[1])]
+    assert_equals(summaries[0], 'Weekly event over midnight')
+    assert "New Year's Day" in summaries
+    assert 'Single event at noon' not in summaries
+
+
+def freebusy_test():
+    assert_equals(list(merge_periods([(1, 3), (2, 4), (4, 5), (6, 7)])),
+                  [(1, 5), (6, 7)])
+    cal = dayplan(StringIO(test_calendar + """
+10/5/2009  9:0:0  2:0:0  0:0:0  0:0:0  ---------- 0 0
+R    86400 1254960000 0 0 0
+N    Daily meeting, ends on the 8th
+10/6/2009  10:0:0  2:0:0  0:0:0  0:0:0  ---------- 0 0
+N    Overlaps the meeting
+10/7/2009  23:0:0  2:0:0  0:0:0  0:0:0  ---------- 0 0
+N    Runs past the end of the window
+"""))
+    window = (datetime.datetime(2009, 10, 6), datetime.datetime(2009, 10, 8))
+    utc = lambda value: value.replace(tzinfo=defaultTZ).astimezone(
+        vobject.icalendar.utc)
+    # the all-day events in test_calendar are transparent
+    assert_equals(list(cal.busy(*window)), [
+        (utc(datetime.datetime(2009, 10, 6, 9)),
+         utc(datetime.datetime(2009, 10, 6, 12))),
+        (utc(datetime.datetime(2009, 10, 7, 9)),
+         utc(datetime.datetime(2009, 10, 7, 11))),
+        (utc(datetime.datetime(2009, 10, 7, 23)),
+         utc(datetime.datetime(2009, 10, 8)))])
+    text = u''.join(cal.iter_freebusy(window))
+    assert_equals(text.count(u'FREEBUSY:'), 3)
+    assert u'BEGIN:VEVENT' not in text
+
+
+def watch_test():
+    fd, name = tempfile.mkstemp()
+    os.write(fd, test_calendar)
+    os.close(fd)
+    entry = '10/5/2009  12:0:0  1:0:0  0:0:0  0:0:0  ---------- 0 0\n'
+    try:
+        # inotify if it is installed, and stat() polling
+        for inotify in set([plan2ics.pyinotify, None]):
+            saved, plan2ics.pyinotify = plan2ics.pyinotify, inotify
+            try:
+                changes = watch_changes([name], 0.01)
+                with open(name, 'a') as fh:
+                    fh.write(entry + 'N    Added\n')
+                assert_equals(changes.next(), name)
+            finally:
+                plan2ics.pyinotify = saved
+
+        def edits():
+            with open(name, 'a') as fh:
+                fh.write(entry + 'N    Added while watching\n')
+            yield name
+        watch([name], changes=edits())
+        with open(name + '.ics') as fh:
+            ics = fh.read()
+        assert 'SUMMARY:Added while watching' in ics
+        assert 'SUMMARY:Added\r\n' in ics
+    finally:
+        os.unlink(name)
+        if os.path.exists(name + '.ics'):
+            os.unlink(name + '.ics')
+
+
+def gendayplan_test():
+    text = ''.join(gendayplan.generate(300, seed=5))
+    assert_equals(''.join(gendayplan.generate(300, seed=5)), text)
+    assert text != ''.join(gendayplan.generate(300, seed=6))
+    calendar = dayplan(StringIO(text))
+    assert_equals(len(calendar.events), 300)
+    # every kind of entry turns up
+    assert '99:99:99' in text
+    assert re.search(r'^R\t', text, re.M)
+    assert re.search(r'^E\t', text, re.M)
+    assert any(event.rruleset for event in calendar.events)
+    assert any(not isinstance(event.dtstart, datetime.datetime)
+               for event in calendar.events)
+    # round trips like any other plan file
+    out = StringIO()
+    calendar.save_plan(out)
+    saved = dayplan(StringIO(out.getvalue()))
+    assert_equals([event.summary for event in saved.events],
+                  [event.summary for event in calendar.events])
+
+    text = ''.join(gendayplan.generate(50, mix={'unicode': 1, 'repeat': 0}))
+    assert 'R\t' not in text
+    text.decode('utf-8')
+    assert max(text) > '\x7f'
+
+
+def stats_test():
+    records = []
+    hook = lambda *record: records.append(record)
+    planstats.subscribe(hook)
+    try:
+        calendar = dayplan(StringIO(test_calendar),
+                           datetime.timedelta(weeks=1))
+        calendar.pprint()
+    finally:
+        planstats.unsubscribe(hook)
+    entries = len(calendar.events)
+    totals = {}
+    for stage, count, wall, cpu in records:
+        totals[stage] = totals.get(stage, 0) + count
+        assert wall >= 0 and cpu >= 0
+    assert_equals(totals['read'], entries)
+    assert_equals(totals['parse'], entries)
+    assert_equals(totals['filter'], entries)
+    assert_equals(totals['dropped'], entries - len(calendar.current_events))
+    assert_equals(totals['recurrences'],
+                  sum(len(event.rrules) for event in calendar.events))
+    assert_equals(totals['serialize'], len(calendar.current_events))
+
+    # nothing is recorded once the hook has gone
+    assert not planstats.enabled
+    del records[:]
+    dayplan(StringIO(test_calendar)).pprint()
+    assert_equals(records, [])
+    stream = StringIO(test_calendar)
+    assert planstats.timed_iter('read', stream) is stream
+
+    stats = planstats.Stats()
+    stats('parse', 2, 0.5, 0.25)
+    stats('parse', 1, 0.5, 0.25)
+    stats('bytes out', 100, 0, 0)
+    assert_equals(stats.as_dict()['parse'],
+                  {'count': 3, 'wall': 1.0, 'cpu': 0.5})
+    assert 'bytes out' in stats.report()
+    assert '"count": 100' in stats.report('json')
+
+
+def lazy_module_test():
+    sys.modules.pop('colorsys', None)
+    colorsys = LazyModule('colorsys')
+    assert 'colorsys' not in sys.modules
+    assert_equals(colorsys.rgb_to_hsv(1.0, 0.0, 0.0), (0.0, 1.0, 1.0))
+    assert 'colorsys' in sys.modules
+    assert colorsys
+
+    missing = LazyModule('no_such_module_here', optional=True)
+    assert not missing
+    try:
+        LazyModule('no_such_module_here').anything
+    except ImportError:
+        pass
+    else:
+        assert False, 'imported a module that does not exist'
+
+
+def zoneinfo_test():
+    timezone = zoneinfo('Pacific/Auckland')
+    assert zoneinfo('Pacific/Auckland') is timezone
+    plan = test_calendar + """
+10/5/2009  12:0:0  1:0:0  0:0:0  0:0:0  ---------- 0 0
+N    Lunch
+"""
+    calendar = dayplan(StringIO(plan), timezone=timezone)
+    assert_equals(calendar.tzid, 'Pacific/Auckland')
+    ics = calendar.pprint()
+    assert 'TZID:Pacific/Auckland' in ics
+    assert 'DTSTART;TZID=Pacific/Auckland:20091005T120000' in ics
+    # the offset follows daylight saving, in NZDT from late September
+    lunch = [event for event in calendar.events if event.summary == 'Lunch']
+    assert_equals(lunch[0].dtstart.utcoffset(), datetime.timedelta(hours=13))
+    try:
+        zoneinfo('Nowhere/Land')
+    except ValueError:
+        pass
+    else:
+        assert False, 'found a timezone that does not exist'
+
+
+def vtimezone_test():
+    timezone = zoneinfo('Pacific/Auckland')
+    plan = """
+10/5/2009  12:0:0  1:0:0  0:0:0  0:0:0  ---------- 0 0
+N    Lunch
+3/1/2011  9:0:0  1:0:0  0:0:0  0:0:0  ---------- 0 0
+R    604800 1309478400 0 0 0
+N    Weekly until July 2011
+1/1/1999  99:99:99  0:0:0  0:0:0  0:0:0  ---------- 0 0
+N    All day events are not in the timezone
+"""
+    calendar = dayplan(StringIO(plan), timezone=timezone)
+    header = calendar._ics_header(
+        calendar._span(calendar.current_events))
+    assert_equals(calendar._span(calendar.current_events), (2009, 2011))
+    starts = re.findall(r'DTSTART:(\d{4})', header)
+    assert_equals(min(starts), '2008')
+    assert max(starts) <= '2011'
+    # only the transitions of those years, not of 2000..2030
+    everything = dayplan(timezone=timezone)._ics_header()
+    assert len(header) < len(everything)
+    assert header in calendar.pprint()
+    # the VTIMEZONE is only worked out once for each span
+    assert dayplan(StringIO(plan), timezone=timezone).vtimezone is \
+        calendar.vtimezone
+    # the span can be left out, and another timezone with the same name
+    # gets its own VTIMEZONE
+    assert plan2ics.vtimezone(timezone, 'Pacific/Auckland') is \
+        plan2ics.vtimezone(timezone, 'Pacific/Auckland')
+    auckland = plan2ics.ics_header(timezone, 'Pacific/Auckland', (2009, 2009))
+    london = plan2ics.ics_header(zoneinfo('Europe/London'),
+                                 'Pacific/Auckland', (2009, 2009))
+    assert 'TZOFFSETTO:+1300' in auckland
+    assert 'TZOFFSETTO:+0100' in london
+
+    # an event of its own gets the VTIMEZONE for its own years
+    lunch = calendar.event_ics(calendar.events[0])
+    assert 'DTSTART:2008' in lunch
+    assert 'DTSTART:2011' not in lunch
+
+    # an event early in January still has an observance before it
+    january = """
+1/5/2009  9:0:0  1:0:0  0:0:0  0:0:0  ---------- 0 0
+N    Back at work
+"""
+    calendar = dayplan(StringIO(january),
+                       timezone=zoneinfo('America/New_York'))
+    for ics in (calendar.pprint(), calendar.event_ics(calendar.events[0])):
+        onsets = re.findall(r'DTSTART:(\d{8}T\d{6})\r\n', ics)
+        assert min(onsets) <= '20090105T090000', onsets
+
+    # repeats without an end are covered for years to come
+    forever = plan.replace('R    604800 1309478400', 'R    604800 0')
+    calendar = dayplan(StringIO(forever), timezone=timezone)
+    assert_equals(calendar._span(calendar.current_events),
+                  (2009, datetime.date.today().year +
+                   plan2ics.vtimezone_years))
+
+
+def decode_test():
+    assert_equals(decode_header('9/11/2009  12:30:5'),
+                  datetime.datetime(2009, 9, 11, 12, 30, 5))
+    assert_equals(decode_header('9/11/2009  99:99:99'),
+                  datetime.date(2009, 9, 11))
+    # the years plan(4) allows
+    assert_equals(decode_date('1/2/70'), datetime.date(1970, 1, 2))
+    assert_equals(decode_date('12/31/99'), datetime.date(1999, 12, 31))
+    assert_equals(decode_date('1/2/00'), datetime.date(2000, 1, 2))
+    assert_equals(decode_date('1/2/38'), datetime.date(2038, 1, 2))
+    assert_equals(decode_date('1/2/1970'), datetime.date(1970, 1, 2))
+    for text in ('1/2/50', '13/1/2009', '2/30/2009', '1/2', 'a/b/c'):
+        try:
+            decode_date(text)
+        except ValueError:
+            pass
+        else:
+            assert False, 'decoded %s' % text
+    try:
+        decode_header('9/11/2009  25:0:0')
+    except ValueError:
+        pass
+    else:
+        assert False, 'decoded an hour of 25'
+    assert decode_header('9/11/2009  12:30:5') is \
+        decode_header('9/11/2009  12:30:5')
+
+    assert_equals(decode_fields('  1:30:0  0:10:0  0:0:0  ---------- 0 0'),
+                  (datetime.timedelta(hours=1, minutes=30),
+                   datetime.timedelta(minutes=10), datetime.timedelta(0)))
+    assert_equals(decode_fields(''), (None, None, None))
+    assert_equals(decode_fields('  1:0:0  x'),
+                  (datetime.timedelta(hours=1), None, None))
+
+    # the memo is emptied when it fills, and decodes the same after
+    saved = plan2ics.decode_memo_size
+    plan2ics.decode_memo_size = 4
+    try:
+        for day in range(1, 20):
+            assert_equals(decode_date('1/%d/09' % day),
+                          datetime.date(2009, 1, day))
+        assert len(plan2ics._dates) <= 4
+    finally:
+        plan2ics.decode_memo_size = saved
+
+    plan = """
+10/5/09  12:0:0  1:30:0  0:15:0  0:0:0  ---------- 0 0
+R    86400 0 0 0 0
+E    10/7/09
+N    Two digit years
+"""
+    event = dayplan(StringIO(plan)).events[0]
+    assert_equals(plan2ics._naive(event.dtstart),
+                  datetime.datetime(2009, 10, 5, 12))
+    assert_equals(plan2ics._naive(event.dtend),
+                  datetime.datetime(2009, 10, 5, 13, 30))
+    assert_equals(event.exdates, [datetime.datetime(2009, 10, 7, 12)])
+    assert_equals(event.warnings, (datetime.timedelta(minutes=15),
+                                   datetime.timedelta(0)))
+
+
+def expand_ics_test():
+    plan = """
+10/5/2009  12:0:0  1:0:0  0:0:0  0:0:0  ---------- 0 0
+R    86400 0 0 0 0
+N    Daily lunch
+10/12/2009  99:99:99  0:0:0  0:0:0  0:0:0  ---------- 0 0
+N    Holiday
+"""
+    window = parse_window('2009-10-01..2009-10-31')
+    calendar = dayplan(StringIO(plan))
+    # 27 lunches from the 5th, and the holiday
+    assert_equals(calendar.pprint(window).count('BEGIN:VEVENT'), 28)
+    streamed = u''.join(dayplan().iter_ics(StringIO(plan), window))
+    assert_equals(streamed.count('BEGIN:VEVENT'), 28)
+    assert 'BEGIN:VTIMEZONE' in streamed
@@ -0,0 +1,503 @@
+# -*- coding: utf-8 -*-
+
+# Tests are run using nose
+
+from nose.tools import assert_equals
+
+from plan2ics import dayplan, zoneinfo
+from upload2davical import Connections, sync_file, basic_auth, login_ics
+from upload2davical import get_userUrl, upload_file, upload_files, submit_ics
+from upload2davical import get_collections, parse_davical_time, IcsChunks
+from StringIO import StringIO
+import BaseHTTPServer
+import SocketServer
+import cgi
+import datetime
+import errno
+import httplib
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import urllib2
+import zlib
+import plan2ics
+import upload2davical
+import MultipartPostHandler
+import planstats
+import pytz
+
+
+test_calendar = """
+9/11/2009  99:99:99  0:0:0  0:0:0  0:0:0  ---------- 0 0
+R    0 0 0 0 1
+N    Yearly event
+10/5/2009  12:0:0  1:0:0  0:0:0  0:0:0  ---------- 0 0
+N    Lunch
+M    with Bob
+10/6/2009  16:0:0  1:30:0  0:0:0  0:0:0  ---------- 0 0
+N    Meeting
+"""
+
+
+class DaviCalHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # a stand-in for the parts of DaviCal that are used: the login, the
+    # user pages, and CalDAV resources
+    protocol_version = 'HTTP/1.1'
+    resources = {}
+    requests = []
+    uploads = {}
+    caldav = True
+    # the content codings taken in request bodies, and the ones received
+    decodes = ('gzip', 'deflate')
+    encodings = []
+    lock = threading.Lock()
+
+    def reply(self, code, body='', headers={}):
+        if body and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = zlib.compress(body)
+            headers = dict(headers, **{'Content-Encoding': 'deflate'})
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def record(self):
+        with self.lock:
+            self.requests.append((self.command, self.path,
+                                  self.headers.get('Authorization'),
+                                  self.client_address))
+
+    def body(self):
+        # returns the request body, or None if it cannot be decoded
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        encoding = self.headers.get('Content-Encoding')
+        with self.lock:
+            self.encodings.append(encoding)
+        if encoding is None:
+            return body
+        if encoding in self.decodes:
+            return MultipartPostHandler.decode(body, encoding)
+        return None
+
+    def logged_in(self):
+        return 'session=bob' in self.headers.get('Cookie', '')
+
+    def do_GET(self):
+        self.record()
+        if not self.logged_in():
+            self.reply(403)
+        elif self.path == '/':
+            self.reply(200, 'Welcome')
+        elif self.path == '/users.php':
+            self.reply(200, '<a href="/users.php?user_no=3">My Details</a>')
+        elif self.path == '/users.php?user_no=3':
+            self.reply(200, '<table><tr><td><a href="#">/bob/old/</a></td>'
+                       '<td></td><td></td><td>2030-01-01 12:00:00.5+13</td>'
+                       '</tr></table>')
+        else:
+            self.reply(404)
+
+    def do_POST(self):
+        self.record()
+        body = self.body()
+        if body is None:
+            self.reply(415)
+        elif self.path == '/index.php':
+            if body == 'username=bob&password=secret':
+                self.reply(302, headers={'Location': '/',
+                                         'Set-Cookie': 'session=bob'})
+            else:
+                self.reply(403)
+        elif self.path == '/users.php?user_no=3&edit=1' and self.logged_in():
+            form = cgi.FieldStorage(StringIO(body), {
+                'content-type': self.headers['Content-Type'],
+                'content-length': str(len(body))},
+                environ={'REQUEST_METHOD': 'POST'})
+            with self.lock:
+                self.uploads[form.getfirst('path_ics')] = (
+                    form.getfirst('user_no'), form.getfirst('ics_file'))
+            self.reply(200, 'Updated')
+        else:
+            self.reply(403)
+
+    def do_PROPFIND(self):
+        self.record()
+        self.rfile.read(int(self.headers['Content-Length']))
+        if not self.caldav:
+            self.reply(405)
+        elif self.path != '/caldav.php/bob/' or self.headers['Depth'] != '1':
+            self.reply(404)
+        else:
+            self.reply(207, """<?xml version="1.0" encoding="utf-8"?>
+<multistatus xmlns="DAV:">
+ <response><href>/caldav.php/bob/</href><propstat><prop>
+  <getlastmodified>Mon, 05 Oct 2009 01:00:00 GMT</getlastmodified>
+ </prop></propstat></response>
+ <response><href>/caldav.php/bob/old/</href><propstat><prop>
+  <getlastmodified>Tue, 01 Jan 2030 00:00:00 GMT</getlastmodified>
+  <getetag>"1234"</getetag>
+ </prop></propstat></response>
+ <response><href>http://localhost/caldav.php/bob/my%20work/</href><propstat><prop>
+  <getlastmodified>Sat, 01 Jan 2000 00:00:00 GMT</getlastmodified>
+  <getetag>"5678"</getetag>
+ </prop></propstat></response>
+</multistatus>""", {'Content-Type': 'application/xml'})
+
+    def do_PUT(self):
+        self.record()
+        body = self.body()
+        if body is None:
+            self.reply(415)
+            return
+        with self.lock:
+            self.resources[self.path] = body
+        self.reply(201)
+
+    def do_DELETE(self):
+        self.record()
+        with self.lock:
+            found = self.resources.pop(self.path, None)
+        self.reply(204 if found else 404)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def serve():
+    DaviCalHandler.resources.clear()
+    DaviCalHandler.uploads.clear()
+    DaviCalHandler.caldav = True
+    DaviCalHandler.decodes = ('gzip', 'deflate')
+    del DaviCalHandler.encodings[:]
+    del DaviCalHandler.requests[:]
+    server = Server(('127.0.0.1', 0), DaviCalHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def sync_test():
+    server = serve()
+    directory = tempfile.mkdtemp()
+    try:
+        file = os.path.join(directory, 'work')
+        with open(file, 'w') as fh:
+            fh.write(test_calendar)
+        http = Connections('http://127.0.0.1:%d' % server.server_port, 10)
+        collection = '/caldav.php/bob/work/'
+        auth = basic_auth('bob', 'secret')
+        manifest_dir = os.path.join(directory, 'manifests')
+        uids = [pevent.uid for pevent in dayplan(StringIO(test_calendar)).events]
+
+        sync_file(file, http, collection, auth, manifest_dir)
+        assert_equals(sorted(DaviCalHandler.resources),
+                      sorted('/caldav.php/bob/work/%s.ics' % uid
+                             for uid in uids))
+        assert_equals(set(request[2] for request in DaviCalHandler.requests),
+                      set(['Basic Ym9iOnNlY3JldA==']))
+        body = DaviCalHandler.resources['/caldav.php/bob/work/%s.ics' % uids[1]]
+        assert 'SUMMARY:Lunch' in body
+        assert 'BEGIN:VTIMEZONE' in body
+        assert_equals(body.count('BEGIN:VEVENT'), 1)
+
+        # nothing changed, so nothing is sent
+        del DaviCalHandler.requests[:]
+        sync_file(file, http, collection, auth, manifest_dir, force=True)
+        assert_equals(DaviCalHandler.requests, [])
+
+        # nor after the script lines are saved into the file, or the
+        # entry cache format changes
+        calendar = dayplan(StringIO(test_calendar))
+        with open(file, 'w') as fh:
+            calendar.save_plan(fh)
+        saved, plan2ics.cache_version = plan2ics.cache_version, 'new'
+        try:
+            sync_file(file, http, collection, auth, manifest_dir, force=True)
+        finally:
+            plan2ics.cache_version = saved
+        assert_equals(DaviCalHandler.requests, [])
+
+        # one event changed and one removed
+        with open(file, 'w') as fh:
+            # the UID is made from the start and the M lines, so it stays
+            fh.write(test_calendar.replace('N    Lunch', 'N    Long lunch')
+                     .replace('N    Meeting\n', '')
+                     .replace('10/6/2009  16:0:0  1:30:0  0:0:0  0:0:0  '
+                              '---------- 0 0\n', ''))
+        os.utime(file, (1000, 1000))
+        sync_file(file, http, collection, auth, manifest_dir)
+        changed = uids[1]
+        assert_equals([request[:2] for request in DaviCalHandler.requests],
+                      [('PUT', '/caldav.php/bob/work/%s.ics' % changed),
+                       ('DELETE', '/caldav.php/bob/work/%s.ics' % uids[2])])
+        assert 'SUMMARY:Long lunch' in DaviCalHandler.resources[
+            '/caldav.php/bob/work/%s.ics' % changed]
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+def sync_timezone_test():
+    server = serve()
+    directory = tempfile.mkdtemp()
+    try:
+        file = os.path.join(directory, 'work')
+        with open(file, 'w') as fh:
+            fh.write(test_calendar)
+        http = Connections('http://127.0.0.1:%d' % server.server_port, 10)
+        collection = '/caldav.php/bob/work/'
+        auth = basic_auth('bob', 'secret')
+        manifest_dir = os.path.join(directory, 'manifests')
+        sync_file(file, http, collection, auth, manifest_dir,
+                  timezone=zoneinfo('Pacific/Auckland'))
+        count = len(DaviCalHandler.requests)
+        for body in DaviCalHandler.resources.values():
+            assert 'TZID:Pacific/Auckland' in body
+        # the events are all sent again in another timezone
+        del DaviCalHandler.requests[:]
+        sync_file(file, http, collection, auth, manifest_dir, force=True,
+                  timezone=zoneinfo('Europe/London'))
+        assert_equals(len(DaviCalHandler.requests), count)
+        for body in DaviCalHandler.resources.values():
+            assert 'TZID:Europe/London' in body
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+def upload_test():
+    server = serve()
+    directory = tempfile.mkdtemp()
+    upload2davical.TZ = pytz.timezone('Pacific/Auckland')
+    try:
+        http = Connections('http://127.0.0.1:%d' % server.server_port, 10)
+        login_ics(http, '/index.php', 'bob', 'secret')
+        user_url, user_id = get_userUrl(http, '/users.php')
+        assert_equals((user_url, user_id), ('/users.php?user_no=3', '3'))
+        files = []
+        for name in ('work', 'home', 'old'):
+            files.append(os.path.join(directory, name))
+            with open(files[-1], 'w') as fh:
+                fh.write(test_calendar)
+
+        collections = get_collections(http, user_url, 'bob',
+                                      basic_auth('bob', 'secret'))
+
+        def upload(file):
+            upload_file(file, http, user_url, user_id, 'bob', collections)
+        del DaviCalHandler.requests[:]
+        assert_equals(upload_files(files, upload, 2), [])
+        # no more requests for the modification times
+        assert_equals(sorted(request[:2] for request in DaviCalHandler.requests),
+                      [('POST', '/users.php?user_no=3&edit=1')] * 2)
+        # old was changed on the server after the file was
+        assert_equals(sorted(DaviCalHandler.uploads), ['home', 'work'])
+        user_no, ics = DaviCalHandler.uploads['work']
+        assert_equals(user_no, '3')
+        assert_equals(ics.count('BEGIN:VEVENT'), 3)
+
+        # the failures are returned, not raised
+        assert_equals(upload_files(files + ['missing'], upload, 2),
+                      ['missing'])
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+def ics_chunks_test():
+    calendar = dayplan(StringIO(test_calendar))
+    chunks = IcsChunks(calendar)
+    body = MultipartPostHandler.MultipartBody([], [('ics_file', (
+        'work.ics', chunks, chunks.size))])
+    sent = body.read()
+    assert_equals(len(sent), len(body))
+    assert_equals(sent.count('BEGIN:VEVENT'), 3)
+    # the chunks are made again when the body is sent again
+    body.seek(0)
+    assert_equals(len(body.read()), len(sent))
+
+
+def keep_alive_test():
+    server = serve()
+    directory = tempfile.mkdtemp()
+    try:
+        http = Connections('http://127.0.0.1:%d' % server.server_port, 10)
+        auth = basic_auth('bob', 'secret')
+        files = []
+        for i in range(40):
+            files.append(os.path.join(directory, 'calendar%d' % i))
+            with open(files[-1], 'w') as fh:
+                fh.write(test_calendar)
+
+        def upload(file):
+            sync_file(file, http, '/caldav.php/bob/%s/' % os.path.basename(
+                file), auth, os.path.join(directory, 'manifests'))
+        stats = planstats.Stats()
+        planstats.subscribe(stats)
+        try:
+            assert_equals(upload_files(files, upload, 4), [])
+        finally:
+            planstats.unsubscribe(stats)
+        assert_equals(len(DaviCalHandler.resources), 120)
+        # the threads all counted into the same totals
+        totals = stats.as_dict()
+        assert_equals(totals['upload']['count'], 40)
+        assert_equals(totals['http']['count'], 120)
+        assert_equals(totals['parse']['count'], 120)
+        assert totals['bytes sent']['count'] > 120 * 100
+        # every request went over one of the four connections
+        assert http.opened <= 4
+        assert len(set(request[3] for request in
+                       DaviCalHandler.requests)) <= 4
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+
+
+class FailingConnection(object):
+    # stands in for an HTTPConnection, raising error from each request
+    def __init__(self, error):
+        self.error = error
+        self.sent = 0
+    def request(self, *args):
+        self.sent += 1
+        raise self.error
+    def close(self):
+        pass
+
+
+def retry_test():
+    http = Connections('http://127.0.0.1:1', 10)
+    for error, sent in ((socket.timeout('timed out'), 1),
+                        (socket.error(errno.ETIMEDOUT, 'timed out'), 1),
+                        (socket.error(errno.ECONNRESET, 'reset'), 2),
+                        (httplib.BadStatusLine(''), 2)):
+        connection = FailingConnection(error)
+        # the connection was kept alive from an earlier request
+        http.connection = lambda: (connection, connection.sent == 0)
+        try:
+            http.request('PUT', '/caldav.php/bob/home/1.ics', 'BEGIN:VCALENDAR')
+        except type(error):
+            pass
+        # only a connection the server closed is tried again, not a timeout
+        assert_equals(connection.sent, sent)
+
+
+def collections_test():
+    server = serve()
+    upload2davical.TZ = pytz.timezone('Pacific/Auckland')
+    try:
+        http = Connections('http://127.0.0.1:%d' % server.server_port, 10)
+        login_ics(http, '/index.php', 'bob', 'secret')
+        auth = basic_auth('bob', 'secret')
+        utc = pytz.utc
+        assert_equals(get_collections(http, '/users.php?user_no=3', 'bob', auth), {
+            '/bob/': (datetime.datetime(2009, 10, 5, 1, tzinfo=utc), None),
+            '/bob/old/': (datetime.datetime(2030, 1, 1, tzinfo=utc), '"1234"'),
+            '/bob/my work/': (datetime.datetime(2000, 1, 1, tzinfo=utc),
+                              '"5678"')})
+        # without CalDAV, the user page is scraped
+        DaviCalHandler.caldav = False
+        assert_equals(get_collections(http, '/users.php?user_no=3', 'bob', auth), {
+            '/bob/old/': (datetime.datetime(2029, 12, 31, 23, tzinfo=utc), None)})
+    finally:
+        server.shutdown()
+
+
+def parse_davical_time_test():
+    upload2davical.TZ = pytz.timezone('Pacific/Auckland')
+    utc = pytz.utc
+    assert_equals(parse_davical_time('2009-10-05 12:00:00.123+13'),
+                  datetime.datetime(2009, 10, 4, 23, tzinfo=utc))
+    assert_equals(parse_davical_time('2009-10-05 12:00:00-05:30'),
+                  datetime.datetime(2009, 10, 5, 17, 30, tzinfo=utc))
+    # no offset, so in the local timezone, which is +13 in October
+    assert_equals(parse_davical_time(' 2009-10-05 12:00:00 '),
+                  datetime.datetime(2009, 10, 4, 23, tzinfo=utc))
+    assert_equals(parse_davical_time('yesterday'), None)
+
+
+def multipart_body_test():
+    fd, name = tempfile.mkstemp(suffix='.ics')
+    os.write(fd, 'BEGIN:VCALENDAR\r\n' * 1000)
+    os.close(fd)
+    try:
+        with open(name, 'rb') as fh:
+            vars = [('path_ics', 'work'), ('user_no', '3')]
+            boundary, encoded = MultipartPostHandler.MultipartPostHandler \
+                .multipart_encode(vars, [('ics_file', fh)], 'BOUNDARY')
+            body = MultipartPostHandler.MultipartBody(
+                vars, [('ics_file', fh)], 'BOUNDARY')
+            assert_equals(len(body), len(encoded))
+            # read in pieces smaller and larger than a chunk
+            pieces = [body.read(7), body.read(10000), body.read()]
+            assert_equals(''.join(pieces), encoded)
+            assert_equals(body.read(), '')
+            body.seek(0)
+            assert_equals(body.read(), encoded)
+
+        chunks = iter(['BEGIN:VCALENDAR\r\n', 'END:VCALENDAR\r\n'])
+        body = MultipartPostHandler.MultipartBody(
+            [], [('ics_file', ('work.ics', chunks, 32))], 'BOUNDARY')
+        data = body.read()
+        assert_equals(len(data), len(body))
+        assert 'Content-Type: text/calendar\r\n\r\nBEGIN:VCALENDAR' in data
+        try:
+            body.seek(0)
+        except IOError:
+            pass
+        else:
+            assert False, 'an iterator cannot be read twice'
+    finally:
+        os.unlink(name)
+
+
+def compressed_upload_test():
+    server = serve()
+    directory = tempfile.mkdtemp()
+    try:
+        file = os.path.join(directory, 'work')
+        with open(file, 'w') as fh:
+            fh.write(test_calendar)
+        auth = basic_auth('bob', 'secret')
+        http = Connections('http://127.0.0.1:%d' % server.server_port, 10,
+                           encoding='gzip')
+        sync_file(file, http, '/caldav.php/bob/work/', auth,
+                  os.path.join(directory, 'manifests'))
+        assert_equals(DaviCalHandler.encodings, ['gzip'] * 3)
+        assert all('BEGIN:VEVENT' in body
+                   for body in DaviCalHandler.resources.values())
+
+        # a server which does not take compressed bodies gets them plain
+        DaviCalHandler.decodes = ()
+        del DaviCalHandler.encodings[:]
+        sync_file(file, http, '/caldav.php/bob/home/', auth,
+                  os.path.join(directory, 'manifests'))
+        assert_equals(DaviCalHandler.encodings, ['gzip', None, None, None])
+        assert_equals(http.encoding, None)
+        assert_equals(len(DaviCalHandler.resources), 6)
+
+        # the calendar upload form is never compressed, a server which
+        # cannot read it may not say so
+        DaviCalHandler.decodes = ('gzip', 'deflate')
+        del DaviCalHandler.encodings[:]
+        http = Connections('http://127.0.0.1:%d' % server.server_port, 10,
+                           encoding='gzip')
+        login_ics(http, '/index.php', 'bob', 'secret')
+        with open(file) as fh:
+            submit_ics(http, '/users.php?user_no=3&edit=1', fh, 'work', '3')
+        assert_equals(DaviCalHandler.encodings, [None, None])
+        assert_equals(http.encoding, 'gzip')
+        assert_equals(DaviCalHandler.uploads['work'][1], test_calendar)
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
@@ -18,17 +18,31 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from plan2ics import dayplan
+from plan2ics import dayplan, write_file, zoneinfo
 import os
+import re
 from os.path import basename,splitext
-import tempfile
-import urllib, urllib2
+import urllib, urllib2, urlparse
+import httplib
+import cookielib
 import socket
+import errno
+import sys
+import threading
+from multiprocessing.pool import ThreadPool
 import MultipartPostHandler
+import planstats
 import optparse
 import datetime
+import base64
+import hashlib
+import json
+import email.utils
+from xml.etree import ElementTree
 import pytz
-from BeautifulSoup import BeautifulSoup
+from lazymodule import LazyModule
+# only needed to scrape the DaviCal pages, so imported when first used
+BeautifulSoup = LazyModule('BeautifulSoup')
 
 # class to make required parameters
 # from optparse examples/required_1.py
@@ -44,34 +58,307 @@ def log(msg,verbose=True):
     if verbose:
         print msg
 
-def submit_ics(url,ical,name,id):
-    data = {'path_ics':name, 'ics_file':ical, 'user_no':id, 'submit':'Update'}
-    urllib2.urlopen(url, data).read()
-def login_ics(url,user,passwd):
+class MethodRequest(urllib2.Request):
+    def __init__(self, url, method, data=None, headers={}):
+        urllib2.Request.__init__(self, url, data, headers)
+        self.method = method
+    def get_method(self):
+        return self.method
+class ResponseInfo(object):
+    # what cookielib needs from a response
+    def __init__(self, response):
+        self.response = response
+    def info(self):
+        return self.response.msg
+# the errors from sending on a kept-alive connection the server has
+# already closed, when the request can be sent again. A timeout is not
+# one of them, the server may still be working on the request.
+STALE_ERRNOS = (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+def stale_connection(error):
+    if isinstance(error, (httplib.BadStatusLine, httplib.CannotSendRequest)):
+        return True
+    return isinstance(error, socket.error) and not isinstance(error, socket.timeout) \
+        and error.errno in STALE_ERRNOS
+class Connections(object):
+    # Keep-alive HTTP connections to one server, one for each thread. They
+    # all share the cookie jar, so a login from one thread counts for all.
+    # encoding is 'gzip' or 'deflate' to compress the bodies of requests
+    # made with compress=True, until the server turns one down.
+    def __init__(self, url, timeout=None, cookies=None, encoding=None):
+        parts = urlparse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.netloc
+        self.timeout = timeout
+        if cookies is None:
+            cookies = cookielib.CookieJar()
+        self.cookies = cookies
+        self.local = threading.local()
+        self.opened = 0
+        self.encoding = encoding
+    def connection(self):
+        # returns (connection, True if it has been used before)
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            return connection, True
+        if self.scheme == 'https':
+            connection = httplib.HTTPSConnection(self.host, timeout=self.timeout)
+        else:
+            connection = httplib.HTTPConnection(self.host, timeout=self.timeout)
+        self.local.connection = connection
+        self.opened += 1
+        return connection, False
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        self.local.connection = None
+        if connection is not None:
+            connection.close()
+    def request(self, method, path, data=None, headers={}, redirects=5, compress=False):
+        # returns the body of the response, and raises urllib2.HTTPError
+        # for error responses
+        url = '%s://%s%s' % (self.scheme, self.host, path)
+        encoding = self.encoding
+        sent = data
+        sent_headers = headers
+        if compress and encoding and data is not None:
+            if hasattr(data, 'seek'):
+                data.seek(0)
+            sent = MultipartPostHandler.CompressedBody(data, encoding)
+            sent_headers = dict(headers)
+            sent_headers['Content-Encoding'] = encoding
+            sent_headers['Content-Length'] = str(len(sent))
+        request = MethodRequest(url, method, None, sent_headers)
+        request.add_unredirected_header('Accept-Encoding', 'gzip, deflate')
+        self.cookies.add_cookie_header(request)
+        while True:
+            connection, reused = self.connection()
+            try:
+                if hasattr(sent, 'seek'):
+                    # a streamed body is sent from the start each time
+                    sent.seek(0)
+                with planstats.timed('http'):
+                    connection.request(method, path, sent, dict(request.header_items()))
+                    response = connection.getresponse()
+                    body = response.read()
+                break
+            except (httplib.HTTPException, socket.error), e:
+                self.close()
+                # the server may have closed a kept-alive connection, so
+                # try again once on a new one
+                if not reused or not stale_connection(e):
+                    raise
+        if planstats.enabled:
+            planstats.count('bytes sent', sent is not None and len(sent) or 0)
+            planstats.count('bytes received', len(body))
+        if response.getheader('connection', '').lower() == 'close' or response.version < 11:
+            self.close()
+        self.cookies.extract_cookies(ResponseInfo(response), request)
+        body = MultipartPostHandler.decode(body, response.getheader('content-encoding'))
+        if sent is not data and response.status in MultipartPostHandler.rejected_encoding:
+            # send it again uncompressed, and stop compressing
+            self.encoding = None
+            if hasattr(data, 'seek'):
+                data.seek(0)
+            return self.request(method, path, data, headers, redirects)
+        location = response.getheader('location')
+        if response.status in (301, 302, 303, 307) and location and redirects:
+            location = urlparse.urlsplit(urlparse.urljoin(url, location))
+            path = location.path + (location.query and '?' + location.query)
+            if response.status == 307:
+                return self.request(method, path, data, headers, redirects - 1, compress)
+            return self.request('GET', path, redirects=redirects - 1)
+        if response.status >= 400:
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, None)
+        return body
+
+class IcsChunks(object):
+    # the calendar as UTF-8 chunks, serialized again each time they are
+    # read, so the whole ICS is never held in memory and a body made from
+    # them can be sent again. The size is worked out by a first pass.
+    def __init__(self, calendar):
+        self.calendar = calendar
+        self.size = sum(len(chunk) for chunk in self)
+    def __iter__(self):
+        for chunk in self.calendar.iter_ics():
+            yield chunk.encode('utf-8')
+def submit_ics(http,path,ical,name,id):
+    # ical is an open file, or (filename, chunks, size), see MultipartBody
+    body = MultipartPostHandler.MultipartBody(
+        [('path_ics', name), ('user_no', id), ('submit', 'Update')],
+        [('ics_file', ical)])
+    # not compressed: a PHP form which cannot read the body still answers
+    # 200, so a turned down upload would go unnoticed
+    http.request('POST', path, body,
+        {'Content-Type': body.content_type, 'Content-Length': str(len(body))})
+def login_ics(http,path,user,passwd):
     # assuming the site expects 'user' and 'pass' as query params
     login_form = urllib.urlencode( { 'username': user, 'password': passwd } )
     # perform login with params
-    f = urllib2.urlopen(url,login_form )
-    f.read()
-    f.close()
-def get_userUrl(url):
-    soup = BeautifulSoup(urllib2.urlopen(url))
+    http.request('POST', path, login_form,
+        {'Content-Type': 'application/x-www-form-urlencoded'})
+def get_userUrl(http,path):
+    soup = BeautifulSoup.BeautifulSoup(http.request('GET', path))
     href = soup.find(text='My Details').parent['href']
     return (href,href.split('=')[1])
-def get_lastModified(url,calendar):
-    soup = BeautifulSoup(urllib2.urlopen(url))
-    try:
-        row = soup.find(text=calendar).parent.parent.parent
-    except:
+# DaviCal shows times the way PostgreSQL writes them, 2009-10-05 12:00:00.123+13
+davical_time_rx = re.compile(
+    r'(?P<time>\d+-\d+-\d+ \d+:\d+:\d+)(\.\d+)?\s*((?P<sign>[+-])(?P<hours>\d\d):?(?P<minutes>\d\d)?)?$')
+propfind_body = """<?xml version="1.0" encoding="utf-8"?>
+<propfind xmlns="DAV:"><prop><getlastmodified/><getetag/></prop></propfind>"""
+def parse_davical_time(text):
+    # returns the time in UTC, times without an offset are in TZ
+    m = davical_time_rx.match(text.strip())
+    if not m:
         return None
-    date = datetime.datetime.strptime(row.findAll('td')[3].contents[0].split('.')[0],'%Y-%m-%d %H:%M:%S')
-    #TODO the split() above is throwing away the TZ info, Should grab this and use it properly...
-    return date.replace(tzinfo=None)
+    date = datetime.datetime.strptime(m.group('time'), '%Y-%m-%d %H:%M:%S')
+    if not m.group('sign'):
+        return TZ.localize(date).astimezone(pytz.utc)
+    offset = datetime.timedelta(hours=int(m.group('hours')),
+                                minutes=int(m.group('minutes') or 0))
+    if m.group('sign') == '-':
+        offset = -offset
+    return (date - offset).replace(tzinfo=pytz.utc)
+def get_collections_html(http,path,username):
+    # the collections are listed on the user page, a row each, with the
+    # last modified time in the fourth column
+    soup = BeautifulSoup.BeautifulSoup(http.request('GET', path))
+    collections = {}
+    for row in soup.findAll('tr'):
+        cells = row.findAll('td')
+        names = row.findAll(text=re.compile('^/%s/.*/$' % re.escape(username)))
+        if len(cells) < 4 or not names:
+            continue
+        modified = parse_davical_time(''.join(cells[3].findAll(text=True)))
+        if modified is not None:
+            collections[unicode(names[0])] = (modified, None)
+    return collections
+def get_collections_caldav(http,username,auth):
+    # one PROPFIND of the principal lists every collection of the user
+    body = http.request('PROPFIND', '/caldav.php/%s/' % urllib.quote(username),
+        propfind_body, {'Authorization': auth, 'Depth': '1',
+                        'Content-Type': 'application/xml; charset=utf-8'})
+    collections = {}
+    for response in ElementTree.fromstring(body).findall('{DAV:}response'):
+        path = urllib.unquote(urlparse.urlsplit(response.findtext('{DAV:}href')).path)
+        if path.startswith('/caldav.php/'):
+            path = path[len('/caldav.php'):]
+        modified = email.utils.parsedate_tz(response.findtext('.//{DAV:}getlastmodified') or '')
+        if modified is None or not path.endswith('/'):
+            continue
+        modified = datetime.datetime.fromtimestamp(email.utils.mktime_tz(modified), pytz.utc)
+        collections[path] = (modified, response.findtext('.//{DAV:}getetag'))
+    return collections
+def get_collections(http,userUrl,username,auth):
+    # returns {'/user/calendar/': (last modified, etag)}, from a single
+    # request. The etag is None when the server has no CalDAV.
+    try:
+        return get_collections_caldav(http, username, auth)
+    except (urllib2.HTTPError, SyntaxError):
+        return get_collections_html(http, userUrl, username)
+def caldav_request(http, path, method, auth, data=None, headers={}):
+    headers = dict(headers, Authorization=auth)
+    try:
+        http.request(method, path, data, headers, compress=True)
+    except urllib2.HTTPError, e:
+        # the event has already gone from the server
+        if not (method == 'DELETE' and e.code == 404):
+            raise
+def basic_auth(user, passwd):
+    return 'Basic ' + base64.b64encode('%s:%s' % (user, passwd))
+def manifest_path(manifest_dir, collection):
+    return os.path.join(manifest_dir, hashlib.md5(collection).hexdigest() + '.json')
+def load_manifest(path):
+    # the manifest is what the server holds after the last sync: the
+    # mtime of the calendar file, and the fingerprint of each UID
+    try:
+        with open(path) as fh:
+            return json.load(fh)
+    except IOError:
+        return {'mtime': None, 'events': {}}
+def save_manifest(path, manifest):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    write_file(path, json.dumps(manifest, sort_keys=True))
+def sync_calendar(calendar, http, collection, auth, manifest, verbose=False):
+    # PUT the added and changed events, and DELETE the removed ones, one
+    # resource per UID. manifest is updated as each request succeeds.
+    synced = manifest['events']
+    current = {}
+    for pevent in calendar.current_events:
+        if pevent.uid in current:
+            log('Skipping second event with UID %s' % pevent.uid, verbose=verbose)
+            continue
+        # the fingerprint of the entry leaves out its script line, so saving
+        # the plan file does not make every event look changed
+        current[pevent.uid] = ('%s %s' % (pevent.hash, calendar.tzid), pevent)
+    put = deleted = 0
+    for uid in sorted(current):
+        key, pevent = current[uid]
+        if synced.get(uid) == key:
+            continue
+        caldav_request(http, collection + urllib.quote(uid) + '.ics', 'PUT', auth,
+                       calendar.event_ics(pevent).encode('utf-8'),
+                       {'Content-Type': 'text/calendar; charset=utf-8'})
+        synced[uid] = key
+        put += 1
+    for uid in sorted(set(synced) - set(current)):
+        caldav_request(http, collection + urllib.quote(uid) + '.ics', 'DELETE', auth)
+        del synced[uid]
+        deleted += 1
+    return put, deleted
+def sync_file(file, http, collection, auth, manifest_dir, force=False, verbose=False, timezone=None):
+    path = manifest_path(manifest_dir, '%s://%s%s' % (http.scheme, http.host, collection))
+    manifest = load_manifest(path)
+    mtime = os.stat(file).st_mtime
+    if not force and manifest['mtime'] == mtime:
+        log('Skipping file %s, it has not changed since the last sync' %(file), verbose=verbose)
+        return
+    log('Syncing file %s' %(file), verbose=verbose)
+    with open(file) as fh:
+        calendar = dayplan(fh, timezone=timezone)
+    try:
+        with planstats.timed('upload'):
+            put, deleted = sync_calendar(calendar, http, collection, auth, manifest, verbose)
+        manifest['mtime'] = mtime
+        log('Sent %d events, deleted %d' %(put, deleted), verbose=verbose)
+    finally:
+        # keep the events that did get through, even after an error
+        save_manifest(path, manifest)
+def upload_file(file, http, userUrl, userId, username, collections, force=False, verbose=False, timezone=None):
+    cal_name = splitext(basename(file))[0]
+    cal_modified = collections.get('/'+username+'/'+cal_name+'/', (None, None))[0]
+    file_modified = get_fileModified(file)
+    if (not force) and (cal_modified != None) and (file_modified <= cal_modified):   # skip the update if davical was updated more recently than the file
+        log('Skipping file %s based on modifications times. File: %s  DaviCal: %s' %(file,file_modified,cal_modified),verbose=verbose)
+        return
+    log('Processing file %s' %(file),verbose=verbose)
+    with open(file) as fh:
+        calendar = dayplan(fh, timezone=timezone)
+
+    # send the serialized events as they are, without joining them or
+    # going through a temporary file
+    chunks = IcsChunks(calendar)
+    with planstats.timed('upload'):
+        submit_ics(http, userUrl + '&edit=1', (cal_name + '.ics', chunks, chunks.size), cal_name, userId)
+def upload_files(files, upload, jobs):
+    # run upload(file) for each file in a pool of jobs threads. Returns the
+    # files which failed.
+    def run(file):
+        try:
+            upload(file)
+        except Exception, e:
+            sys.stderr.write('%s: %s\n' % (file, e))
+            return file
+    pool = ThreadPool(jobs)
+    try:
+        return [file for file in pool.map(run, files, 1) if file is not None]
+    finally:
+        pool.close()
+        pool.join()
 def get_fileModified(file):
     epoch = datetime.datetime(1970,1,1,tzinfo=pytz.timezone('UTC'))
     statinfo = os.stat(file)
-    date = epoch + datetime.timedelta(seconds=statinfo.st_mtime)
-    return date.astimezone(TZ).replace(tzinfo=None)
+    return epoch + datetime.timedelta(seconds=statinfo.st_mtime)
     
 def main():
     usage="usage: %prog [options] calendar [calendar2 calendar3...]"
@@ -96,42 +383,96 @@ def main():
     optparser.add_option('-z','--timezone',dest='tz',
         default='Pacific/Auckland',
         help='set the timezone [default: %default]')
+    optparser.add_option('--calendar-timezone',dest='zone',
+        default=None,
+        help='write the calendars in the timezone called ZONE, from the '
+        'zoneinfo files, instead of the local timezone from ICU')
+    optparser.add_option('--sync',dest='sync',
+        action="store_true",
+        default=False,
+        help='send only the events that changed since the last sync, over CalDAV')
+    optparser.add_option('-m','--manifest-dir',dest='manifest_dir',
+        default=os.path.expanduser('~/.upload2davical'),
+        help='where --sync keeps the state of each calendar [default: %default]')
+    optparser.add_option('-j','--jobs',dest='jobs',
+        default=4,
+        type="int",
+        help='upload up to N calendars at once [default: %default]')
+    optparser.add_option('-t','--timeout',dest='timeout',
+        default=60,
+        type="float",
+        help='seconds to wait for each request [default: %default]')
+    optparser.add_option('--compress',dest='compress',
+        default=None,
+        choices=sorted(MultipartPostHandler.encodings),
+        help='compress the events sent by --sync with gzip or deflate. Servers '
+        'which turn this down are sent them uncompressed.')
+    optparser.add_option('--stats',dest='stats',
+        default=None,
+        action="store_const",
+        const='text',
+        help='print the time taken converting and uploading, the HTTP '
+        'requests made and the bytes sent and received, to stderr')
+    optparser.add_option('--stats-json',dest='stats',
+        action="store_const",
+        const='json',
+        help='the same as --stats, written as JSON')
 
     (opts,args) = optparser.parse_args()
     optparser.check_required('-u')
     optparser.check_required('-p')
-    top_level_url = "http://" + opts.server
 
+    # a zoneinfo timezone for the calendars also saves loading ICU
+    opts.timezone = None
+    if opts.zone:
+        try:
+            opts.timezone = zoneinfo(opts.zone)
+        except ValueError, e:
+            optparser.error(str(e))
     global TZ
     TZ=pytz.timezone(opts.tz)
 
-    # set a really long socket timeout in seconds
-    socket.setdefaulttimeout(None)
-    
-    # build opener with HTTPCookieProcessor
-    opener = urllib2.build_opener( urllib2.HTTPCookieProcessor(), MultipartPostHandler.MultipartPostHandler )
-    urllib2.install_opener( opener )
-
-    login_ics(top_level_url + '/index.php', opts.username, opts.password)
-    (userUrl, userId) = get_userUrl(top_level_url + '/users.php')
-    editUrl=top_level_url + userUrl +'&edit=1'
-
-    log('Logged into server %s. User is %s, Id is %s' %(opts.server,opts.username,userId),verbose=opts.verbose)
-
-    for file in args:
-        cal_name = splitext(basename(file))[0]
-        cal_modified = get_lastModified(top_level_url + userUrl, '/'+opts.username+'/'+cal_name+'/')
-        file_modified = get_fileModified(file)
-        if (not opts.force) and (cal_modified != None) and (file_modified <= cal_modified):   # skip the update if davical was updated more recently than the file
-            log('Skipping file %s based on modifications times. File: %s  DaviCal: %s' %(file,file_modified,cal_modified),verbose=opts.verbose)
-            continue
-        log('Processing file %s' %(file),verbose=opts.verbose)
-        calendar = dayplan(file)
+    stats = None
+    if opts.stats:
+        stats = planstats.Stats()
+        planstats.subscribe(stats)
+    try:
+        with planstats.timed('total', len(args)):
+            failed = upload_all(opts, args)
+    finally:
+        if stats:
+            planstats.unsubscribe(stats)
+            sys.stderr.write(stats.report(opts.stats) + '\n')
+    if failed:
+        sys.exit(1)
+
+def upload_all(opts, args):
+    # upload each calendar in args, returns the ones which failed
+    top_level_url = "http://" + opts.server
+
+    # keep-alive connections, one for each upload thread
+    http = Connections(top_level_url, opts.timeout, encoding=opts.compress)
+
+    if opts.sync:
+        auth = basic_auth(opts.username, opts.password)
+        def upload(file):
+            cal_name = splitext(basename(file))[0]
+            collection = '/caldav.php/%s/%s/' % (urllib.quote(opts.username),
+                urllib.quote(cal_name))
+            sync_file(file, http, collection, auth, opts.manifest_dir, opts.force, opts.verbose, opts.timezone)
+    else:
+        login_ics(http, '/index.php', opts.username, opts.password)
+        (userUrl, userId) = get_userUrl(http, '/users.php')
+
+        log('Logged into server %s. User is %s, Id is %s' %(opts.server,opts.username,userId),verbose=opts.verbose)
+        collections = get_collections(http, userUrl, opts.username,
+            basic_auth(opts.username, opts.password))
+        log('Found %d collections' %(len(collections)),verbose=opts.verbose)
+
+        def upload(file):
+            upload_file(file, http, userUrl, userId, opts.username, collections, opts.force, opts.verbose, opts.timezone)
 
-        temp = tempfile.mkstemp(suffix=".html")
-        os.write(temp[0], calendar.pprint())
-        submit_ics(editUrl,open(temp[1], "rb"),cal_name,userId)
-        os.remove(temp[1])
+    return upload_files(args, upload, opts.jobs)
 
 if __name__ == '__main__':
     main()